@@ -7,23 +7,81 @@ import uuid
 import aiocoap
 
 from common.config import Settings
-from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns
+from common.impairment import load_profile
+from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns, write_run_meta
 from common.fileset import discover_files_by_size, build_iterations_by_filename
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
+from coap.options import SENT_NS_OPTION, VERSION_OPTION
 
 
-async def run(files_dir, counts_by_name, host, port, logger):
-    context = await aiocoap.Context.create_client_context()
+class TcpRxCounter:
+    """Counts bytes actually received on coap+tcp connections in this process.
+
+    aiocoap offers no per-connection statistics, so the transport's
+    data_received is wrapped once; the delta across a transfer is the real
+    server->client byte count including RFC 8323 framing of every BERT block.
+    """
+
+    total = 0
+
+    @classmethod
+    def install(cls) -> None:
+        from aiocoap.transports import tcp
+
+        original = tcp.TcpConnection.data_received
+        if getattr(original, "_rx_counted", False):
+            return
+
+        def data_received(conn, data):
+            cls.total += len(data)
+            original(conn, data)
+
+        data_received._rx_counted = True  # type: ignore[attr-defined]
+        tcp.TcpConnection.data_received = data_received
+
+
+async def create_context(transport: str):
+    if transport == "tcp":
+        TcpRxCounter.install()
+        return await aiocoap.Context.create_client_context(transports=["tcpclient"])
+    return await aiocoap.Context.create_client_context()
+
+
+def base_uri(host, port, transport: str) -> str:
+    scheme = "coap+tcp" if transport == "tcp" else "coap"
+    return f"{scheme}://{host}:{port}"
+
+
+async def run(files_dir, counts_by_name, host, port, logger, tracer: Tracer, log_dir: str, transport: str = "udp"):
+    context = await create_context(transport)
     for file_name, iterations in counts_by_name.items():
-        for i in range(1, iterations + 1):
-            seq = str(uuid.uuid4())
-            uri = f"coap://{host}:{port}/files/{file_name}?seq={seq}&iter={i}"
-            t0 = monotonic_ns()
-            request = aiocoap.Message(code=aiocoap.GET, uri=uri, mtype=aiocoap.CON)
-            response = await context.request(request).response
-            payload = bytes(response.payload or b"")
-            t1 = monotonic_ns()
-            duration_ms = (t1 - t0) / 1e6
+        with profile_segment(file_name, "coap-client", log_dir):
+            await run_file(context, host, port, file_name, iterations, logger, tracer, transport)
+
 
+async def run_file(context, host, port, file_name, iterations, logger, tracer: Tracer, transport: str = "udp"):
+    tcp = transport == "tcp"
+    for i in range(1, iterations + 1):
+        seq = str(uuid.uuid4())
+        uri = f"{base_uri(host, port, transport)}/files/{file_name}?seq={seq}&iter={i}"
+        rx0 = TcpRxCounter.total
+        t0 = monotonic_ns()
+        request = aiocoap.Message(code=aiocoap.GET, uri=uri, mtype=None if tcp else aiocoap.CON)
+        t_req = monotonic_ns()
+        # aiocoap reassembles Block2 internally, so first byte is not visible here.
+        response = await context.request(request).response
+        payload = bytes(response.payload or b"")
+        t1 = monotonic_ns()
+        # UDP: payload only (as before); TCP: bytes really received for this transfer
+        wire_bytes = TcpRxCounter.total - rx0 if tcp else len(payload)
+        duration_ms = (t1 - t0) / 1e6
+        if tracer.enabled:
+            tracer.add_span("serialize", t0, t_req, file=file_name)
+            tracer.add_span("exchange", t_req, t1, file=file_name, iter=i)
+            tracer.mark("last_byte", t1, file=file_name)
+
+        with tracer.span("log_write"):
             logger.write(
                 TransferLogEntry(
                     protocol="coap",
@@ -32,19 +90,107 @@ async def run(files_dir, counts_by_name, host, port, logger):
                     file_size_bytes=len(payload),
                     iteration=i,
                     seq_id=seq,
-                    qos_or_mode="con-block",
+                    qos_or_mode="tcp-bert" if tcp else "con-block",
                     t_start_ns=t0,
                     t_end_ns=t1,
                     duration_ms=duration_ms,
-                    bytes_sent_sender_to_receiver=len(payload),
+                    bytes_sent_sender_to_receiver=wire_bytes,
                     extra_meta=None,
                 )
             )
 
 
+def _uint_option(message, number, default: int) -> int:
+    opts = message.opt.get_option(number)
+    return int.from_bytes(opts[0].encode(), "big") if opts else default
+
+
+async def run_observe(counts_by_name, host, port, logger, tracer: Tracer, log_dir: str, transport: str = "udp", idle_timeout_s: float = 120.0):
+    context = await create_context(transport)
+    for file_name, iterations in counts_by_name.items():
+        with profile_segment(file_name, "coap-observer", log_dir):
+            await observe_file(context, host, port, file_name, iterations, logger, tracer, transport, idle_timeout_s)
+
+
+MAX_OBSERVE_RESTARTS = 5
+
+
+async def observe_file(context, host, port, file_name, iterations, logger, tracer: Tracer, transport: str = "udp", idle_timeout_s: float = 120.0):
+    """Register on /obs/{name} and log every pushed version.
+
+    t_start_ns is the server's publish time carried in the notification and
+    t_end_ns the local receive time of the (fully reassembled) notification.
+    A notification whose blocks could not be assembled (4.08 or ETag change)
+    re-registers; no notification for idle_timeout_s (e.g. a lost final NON)
+    ends this file.
+    """
+    tcp = transport == "tcp"
+    uri = f"{base_uri(host, port, transport)}/obs/{file_name}"
+    received = 0
+    for attempt in range(MAX_OBSERVE_RESTARTS + 1):
+        request = aiocoap.Message(code=aiocoap.GET, uri=uri, mtype=None if tcp else aiocoap.CON, observe=0)
+        pr = context.request(request)
+        try:
+            await asyncio.wait_for(pr.response, idle_timeout_s)
+            # The registration response (version 0) is not logged, so do not bill it
+            rx_prev = TcpRxCounter.total
+            notifications = pr.observation.__aiter__()
+            while True:
+                response = await asyncio.wait_for(notifications.__anext__(), idle_timeout_s)
+                t1 = monotonic_ns()
+                if not response.code.is_successful():
+                    raise aiocoap.error.ResourceChanged()
+                received += 1
+                payload = bytes(response.payload or b"")
+                # TCP: everything received since the previous notification (all its blocks)
+                wire_bytes = TcpRxCounter.total - rx_prev if tcp else len(payload)
+                rx_prev = TcpRxCounter.total
+                version = _uint_option(response, VERSION_OPTION, 0)
+                t0 = _uint_option(response, SENT_NS_OPTION, t1)
+
+                tracer.add_span("notification", t0, t1, file=file_name, version=version)
+                with tracer.span("log_write"):
+                    logger.write(
+                        TransferLogEntry(
+                            protocol="coap",
+                            role="client",
+                            file_name=file_name,
+                            file_size_bytes=len(payload),
+                            iteration=received,
+                            seq_id=f"{file_name}#{version}",
+                            qos_or_mode="observe-tcp" if tcp else f"observe-{response.mtype.name.lower()}",
+                            t_start_ns=t0,
+                            t_end_ns=t1,
+                            duration_ms=(t1 - t0) / 1e6,
+                            bytes_sent_sender_to_receiver=wire_bytes,
+                            extra_meta=None,
+                        )
+                    )
+                # Observe is lossy: versions published during a slow blockwise
+                # transfer are coalesced, so also stop once the last one arrived.
+                if received >= iterations or version >= iterations:
+                    return
+        except asyncio.TimeoutError:
+            print(f"{file_name}: no notification for {idle_timeout_s:g}s after {received} received, giving up")
+            return
+        except (aiocoap.error.Error, StopAsyncIteration) as e:
+            print(f"{file_name}: observation failed ({e!r}), re-registering")
+        finally:
+            if not pr.observation.cancelled:
+                pr.observation.cancel()
+    print(f"{file_name}: observation failed {MAX_OBSERVE_RESTARTS + 1} times, giving up")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--files-dir", default="DataFiles")
+    parser.add_argument("--observe", action="store_true",
+                        help="Register as observer on /obs/{name} instead of issuing one GET per transfer")
+    parser.add_argument("--transport", choices=["udp", "tcp"], default="udp",
+                        help="CoAP over UDP (RFC 7252) or over TCP with BERT blocks (RFC 8323)")
+    parser.add_argument("--observe-timeout", type=float, default=120.0,
+                        help="Seconds without a complete notification before an observed file is given up "
+                             "(must exceed one full transfer of the largest file)")
     args = parser.parse_args()
 
     settings = Settings.load()
@@ -52,17 +198,29 @@ def main() -> None:
     port = settings.endpoints.coap_port
 
     os.makedirs(os.path.join(settings.log_dir, "coap"), exist_ok=True)
-    logger = CsvLogger(os.path.join(settings.log_dir, "coap", "client.csv"))
+    log_name = "observer.csv" if args.observe else "client.csv"
+    profile = load_profile()
+    logger = CsvLogger(os.path.join(settings.log_dir, "coap", log_name), tags={"impairment": profile.name})
+    write_run_meta(settings.log_dir, "coap", "observer" if args.observe else "client", {"impairment": profile.to_map(), "transport": args.transport})
 
     selected = discover_files_by_size(args.files_dir)
     if len(selected) < 4:
         raise SystemExit("Expected 4 files in DataFiles with sizes 100B, 10KB, 1MB, 10MB")
     counts_by_name = build_iterations_by_filename(selected, settings.counts.to_map())
 
+    role = "observer" if args.observe else "client"
+    tracer = Tracer.from_env(f"coap-{role}", settings.log_dir)
+    sampler = ResourceSampler.from_env(f"coap-{role}", "coap", role, settings.log_dir).start()
     try:
-        asyncio.run(run(args.files_dir, counts_by_name, host, port, logger))
+        if args.observe:
+            asyncio.run(run_observe(counts_by_name, host, port, logger, tracer, settings.log_dir, args.transport, args.observe_timeout))
+        else:
+            asyncio.run(run(args.files_dir, counts_by_name, host, port, logger, tracer, settings.log_dir, args.transport))
     except KeyboardInterrupt:
         pass
+    finally:
+        sampler.stop()
+        tracer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,7 @@
+from aiocoap.numbers.optionnumbers import OptionNumber
+
+# Experimental-use elective options carrying the notified version and the
+# server's monotonic_ns at the moment it was published, so observers can log
+# send time. Shared by coap.server and coap.client.
+SENT_NS_OPTION = OptionNumber(65000)
+VERSION_OPTION = OptionNumber(65002)
@@ -1,32 +1,88 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import hashlib
 import os
 import uuid
-from typing import Optional
+from typing import Dict, List, Optional
 
 import aiocoap.resource as resource
 import aiocoap
 from urllib.parse import parse_qs
 
+from aiocoap.optiontypes import BlockOption, UintOption
+
 from common.config import Settings
-from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns
+from common.impairment import load_profile
+from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns, write_run_meta
+from common.fileset import discover_files_by_size, build_iterations_by_filename
+from common.prefork import run_prefork, shard_log_path
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
+from coap.options import SENT_NS_OPTION, VERSION_OPTION
+
+
+def _block2_option_len(num: int, more: bool, szx: int) -> int:
+    # Option 23 from a preceding delta of 0 needs one extended-delta byte
+    value = (num << 4) | (0x8 if more else 0) | szx
+    return 2 + (value.bit_length() + 7) // 8
+
+
+def _chunks(payload_len: int, block_size: int) -> List[int]:
+    if block_size <= 0 or payload_len <= block_size:
+        return [payload_len]
+    return [min(block_size, payload_len - off) for off in range(0, payload_len, block_size)]
+
+
+def estimate_coap_response_bytes(payload_len: int, token_len: int, block_size: int, szx: int) -> int:
+    # RFC 7252 datagrams, summed over every Block2 block the response is split into:
+    # 4 byte header + token + Block2 option + payload marker + payload
+    chunks = _chunks(payload_len, block_size)
+    total = 0
+    for num, chunk in enumerate(chunks):
+        options = _block2_option_len(num, num < len(chunks) - 1, szx) if len(chunks) > 1 else 0
+        total += 4 + token_len + options + (1 + chunk if chunk else 0)
+    return total
+
+
+def estimate_coap_tcp_response_bytes(payload_len: int, token_len: int, block_size: int, szx: int) -> int:
+    # RFC 8323 framing, summed over every (BERT) block the response is split into:
+    # Len/TKL byte + extended length (0/1/2/4) + code + token + Block2 option + marker + payload
+    chunks = _chunks(payload_len, block_size)
+    total = 0
+    for num, chunk in enumerate(chunks):
+        options = _block2_option_len(num, num < len(chunks) - 1, szx) if len(chunks) > 1 else 0
+        length = options + (1 + chunk if chunk else 0)
+        ext = 0 if length < 13 else 1 if length < 269 else 2 if length < 65805 else 4
+        total += 1 + ext + 1 + token_len + length
+    return total
+
 
+def is_tcp_remote(remote) -> bool:
+    return getattr(remote, "scheme", "coap") in ("coap+tcp", "coaps+tcp")
 
-def estimate_coap_response_bytes(payload_len: int, token_len: int, has_block2: bool) -> int:
-    # Very rough estimate: 4 bytes base header + token + minimal options + payload marker if any + payload
-    # Blockwise adds a Block2 option ~ 1-3 bytes typically; we'll assume +2
-    base = 4 + token_len
-    options = 2 if has_block2 else 0
-    payload_marker = 1 if payload_len > 0 else 0
-    return base + options + payload_marker + payload_len
+
+def estimate_response_bytes(request, payload_len: int) -> int:
+    token_len = len(request.token or b"")
+    szx = request.remote.maximum_block_size_exp
+    if szx == 7:
+        block_size = 1024 * (request.remote.maximum_payload_size // 1024)
+    else:
+        block_size = 2 ** (szx + 4)
+    if is_tcp_remote(request.remote):
+        return estimate_coap_tcp_response_bytes(payload_len, token_len, block_size, szx)
+    # Responses that fit one datagram are sent whole
+    if payload_len <= request.remote.maximum_payload_size:
+        block_size = 0
+    return estimate_coap_response_bytes(payload_len, token_len, block_size, szx)
 
 
 class FileResource(resource.Resource):
-    def __init__(self, files_dir: str, logger: CsvLogger):
+    def __init__(self, files_dir: str, logger: CsvLogger, tracer: Tracer):
         super().__init__()
         self.files_dir = files_dir
         self.logger = logger
+        self.tracer = tracer
 
     async def render_get(self, request):
         # Path: files/{name}
@@ -46,43 +102,177 @@ class FileResource(resource.Resource):
         seq = (qmap.get('seq', [str(uuid.uuid4())])[0])
         iteration = int(qmap.get('iter', ['0'])[0])
 
-        with open(path, 'rb') as f:
-            payload = f.read()
+        with self.tracer.span("file_load", file=file_name):
+            with open(path, 'rb') as f:
+                payload = f.read()
 
         t0 = monotonic_ns()
         msg = aiocoap.Message(code=aiocoap.CONTENT, payload=payload)
         t1 = monotonic_ns()
         duration_ms = (t1 - t0) / 1e6
+        self.tracer.add_span("serialize", t0, t1, file=file_name)
+
+        est_bytes = estimate_response_bytes(request, len(payload))
+        mode = "tcp-bert" if is_tcp_remote(request.remote) else "con-block"
 
-        # We cannot know blockwise slicing here; approximate as single response
-        token_len = len(request.token or b"")
-        est_bytes = estimate_coap_response_bytes(len(payload), token_len, has_block2=False)
-
-        self.logger.write(
-            TransferLogEntry(
-                protocol="coap",
-                role="server",
-                file_name=file_name,
-                file_size_bytes=len(payload),
-                iteration=iteration,
-                seq_id=seq,
-                qos_or_mode="con-block",
-                t_start_ns=t0,
-                t_end_ns=t1,
-                duration_ms=duration_ms,
-                bytes_sent_sender_to_receiver=est_bytes,
-                extra_meta=None,
+        with self.tracer.span("log_write"):
+            self.logger.write(
+                TransferLogEntry(
+                    protocol="coap",
+                    role="server",
+                    file_name=file_name,
+                    file_size_bytes=len(payload),
+                    iteration=iteration,
+                    seq_id=seq,
+                    qos_or_mode=mode,
+                    t_start_ns=t0,
+                    t_end_ns=t1,
+                    duration_ms=duration_ms,
+                    bytes_sent_sender_to_receiver=est_bytes,
+                    extra_meta=None,
+                )
             )
-        )
         return msg
 
 
-async def main_async(files_dir: str, host: str, port: int, logger: CsvLogger):
+class ObservableFileResource(resource.ObservableResource):
+    """Pushes `updates` versions of one file to observers, one every `interval_s`.
+
+    Large notifications are served blockwise from a per-observer snapshot.
+    """
+
+    def __init__(self, file_name: str, payload: bytes, updates: int, interval_s: float, mtype, logger: CsvLogger, tracer: Tracer):
+        super().__init__()
+        self.file_name = file_name
+        self.payload = payload
+        self.content_tag = hashlib.sha1(payload).digest()[:4]
+        self.updates = updates
+        self.interval_s = interval_s
+        self.mtype = mtype
+        self.logger = logger
+        self.tracer = tracer
+        self.version = 0
+        self.version_sent_ns = monotonic_ns()
+        self._schedule: Optional[asyncio.Task] = None
+        # blockwise_key -> newest rendered snapshot / snapshot being fetched
+        self._latest: Dict[object, aiocoap.Message] = {}
+        self._active: Dict[object, aiocoap.Message] = {}
+
+    async def needs_blockwise_assembly(self, request):
+        # Block2 is served from the per-notification snapshot below.
+        return False
+
+    async def add_observation(self, request, serverobservation):
+        if self._schedule is not None and self._schedule.done():
+            # Previous run finished; re-arm for this observer
+            self._schedule = None
+            self.version = 0
+            self.version_sent_ns = monotonic_ns()
+        # A (re-)registering client has dropped any transfer it had in progress
+        self._latest.pop(request.remote.blockwise_key, None)
+        self._active.pop(request.remote.blockwise_key, None)
+        await super().add_observation(request, serverobservation)
+        if self._schedule is None:
+            self._schedule = asyncio.create_task(self._run_schedule())
+
+    async def _run_schedule(self):
+        for _ in range(self.updates):
+            await asyncio.sleep(self.interval_s)
+            self.version += 1
+            self.version_sent_ns = monotonic_ns()
+            self.updated_state()
+
+    async def _render_version(self, request):
+        # Called for block 0 only; the result is the snapshot later blocks are cut from.
+        version, sent_ns = self.version, self.version_sent_ns
+        t0 = monotonic_ns()
+        msg = aiocoap.Message(code=aiocoap.CONTENT, payload=self.payload)
+        msg.opt.etag = self.content_tag + version.to_bytes(4, "big")
+        msg.opt.add_option(UintOption(VERSION_OPTION, version))
+        msg.opt.add_option(UintOption(SENT_NS_OPTION, sent_ns))
+        t1 = monotonic_ns()
+        self.tracer.add_span("serialize", t0, t1, file=self.file_name, version=version)
+
+        if request.opt.observe is not None and version > 0:
+            tcp = is_tcp_remote(request.remote)
+            if tcp:
+                mode = "observe-tcp"
+            else:
+                mode = "observe-con" if self.mtype == aiocoap.CON else "observe-non"
+            with self.tracer.span("log_write"):
+                self.logger.write(
+                    TransferLogEntry(
+                        protocol="coap",
+                        role="server",
+                        file_name=self.file_name,
+                        file_size_bytes=len(self.payload),
+                        iteration=version,
+                        seq_id=f"{self.file_name}#{version}",
+                        qos_or_mode=mode,
+                        # publish -> notification rendered for this observer
+                        t_start_ns=sent_ns,
+                        t_end_ns=t1,
+                        duration_ms=(t1 - sent_ns) / 1e6,
+                        bytes_sent_sender_to_receiver=estimate_response_bytes(request, len(self.payload)),
+                        extra_meta=None,
+                    )
+                )
+        return msg
+
+    @staticmethod
+    def _block(full: aiocoap.Message, block2, max_payload: int) -> Optional[aiocoap.Message]:
+        if block2.is_bert:
+            size = 1024 * (max_payload // 1024)
+            start = block2.block_number * 1024
+        else:
+            size = block2.size
+            start = block2.start
+        if start >= len(full.payload):
+            return None
+        end = min(start + size, len(full.payload))
+        more = end < len(full.payload)
+        return full.copy(payload=full.payload[start:end],
+                         block2=BlockOption.BlockwiseTuple(block2.block_number, more, block2.size_exponent))
+
+    async def render_get(self, request):
+        key = request.remote.blockwise_key
+        block2 = request.opt.block2
+        max_payload = request.remote.maximum_payload_size
+
+        if block2 is not None and block2.block_number > 0:
+            if key not in self._active and key in self._latest:
+                self._active[key] = self._latest.pop(key)
+            full = self._active.get(key)
+            msg = self._block(full, block2, max_payload) if full is not None else None
+            if msg is None:
+                return aiocoap.Message(code=aiocoap.REQUEST_ENTITY_INCOMPLETE)
+            if not msg.opt.block2.more:
+                del self._active[key]
+            return msg
+
+        msg = await self._render_version(request)
+        if len(self.payload) > max_payload or (block2 is not None and len(self.payload) > block2.size):
+            self._latest[key] = msg
+            msg = self._block(msg, block2 or BlockOption.BlockwiseTuple(0, True, request.remote.maximum_block_size_exp), max_payload)
+        if request.opt.observe is not None and not is_tcp_remote(request.remote):
+            # Message types only exist on UDP; over TCP the transport is reliable.
+            msg.mtype = self.mtype
+        return msg
+
+
+async def main_async(files_dir: str, host: str, port: int, logger: CsvLogger, tracer: Tracer, observe_iters=None, interval_s: float = 1.0, mtype=aiocoap.CON, transport: str = "udp"):
     root = resource.Site()
     root.add_resource(['files'], resource.PathCapable())
-    root.add_resource(['files', resource.AnyPath()], FileResource(files_dir, logger))
+    root.add_resource(['files', resource.AnyPath()], FileResource(files_dir, logger, tracer))
+    for file_name, updates in (observe_iters or {}).items():
+        with open(os.path.join(files_dir, file_name), 'rb') as f:
+            payload = f.read()
+        root.add_resource(['obs', file_name], ObservableFileResource(file_name, payload, updates, interval_s, mtype, logger, tracer))
 
-    await aiocoap.Context.create_server_context(root, bind=(host, port))
+    # tcpserver negotiates BERT (RFC 8323 large blocks) with peers that support it;
+    # UDP keeps aiocoap's default server transports
+    transports = ["tcpserver"] if transport == "tcp" else None
+    await aiocoap.Context.create_server_context(root, bind=(host, port), transports=transports)
     await asyncio.get_running_loop().create_future()
 
 
@@ -91,6 +281,13 @@ def main() -> None:
     parser.add_argument("--files-dir", default="DataFiles")
     parser.add_argument("--host", default=None)
     parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--observe-interval-ms", type=float, default=1000.0,
+                        help="Interval between pushed versions of each /obs/{name} resource")
+    parser.add_argument("--notify-type", choices=["con", "non"], default="con")
+    parser.add_argument("--transport", choices=["udp", "tcp"], default="udp",
+                        help="CoAP over UDP (RFC 7252) or over TCP with BERT blocks (RFC 8323)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Pre-fork N processes sharing the UDP port via SO_REUSEPORT")
     args = parser.parse_args()
 
     settings = Settings.load()
@@ -98,12 +295,42 @@ def main() -> None:
     port = args.port or settings.endpoints.coap_port
 
     os.makedirs(os.path.join(settings.log_dir, "coap"), exist_ok=True)
-    logger = CsvLogger(os.path.join(settings.log_dir, "coap", "server.csv"))
+    log_path = os.path.join(settings.log_dir, "coap", "server.csv")
+    profile = load_profile()
+    meta = {"impairment": profile.to_map(), "workers": args.workers, "transport": args.transport}
+
+    selected = discover_files_by_size(args.files_dir)
+    observe_iters = build_iterations_by_filename(selected, settings.counts.to_map())
+    mtype = aiocoap.CON if args.notify_type == "con" else aiocoap.NON
+
+    def serve(log_path: str, run_meta: Dict[str, object]) -> None:
+        # Written from the serving process itself so its run_id matches its rows and samples
+        write_run_meta(settings.log_dir, "coap", "server", run_meta)
+        logger = CsvLogger(log_path, tags={"impairment": profile.name})
+        trace_name = "coap-" + os.path.splitext(os.path.basename(log_path))[0]
+        tracer = Tracer.from_env(trace_name, settings.log_dir)
+        # Started per worker: threads do not survive fork()
+        sampler = ResourceSampler.from_env(trace_name, "coap", "server", settings.log_dir).start()
+        try:
+            with profile_segment("serve", trace_name, settings.log_dir):
+                asyncio.run(main_async(args.files_dir, host, port, logger, tracer, observe_iters, args.observe_interval_ms / 1000.0, mtype, args.transport))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sampler.stop()
+            tracer.close()
+
+    if args.workers <= 1:
+        serve(log_path, meta)
+        return
+
+    write_run_meta(settings.log_dir, "coap", "supervisor", meta)
 
-    try:
-        asyncio.run(main_async(args.files_dir, host, port, logger))
-    except KeyboardInterrupt:
-        pass
+    # aiocoap sets SO_REUSEPORT on its server sockets wherever the platform has
+    # it, so workers share the port. The kernel hashes each client's
+    # address/port to one worker, so blockwise follow-ups and observations stay
+    # on the worker that saw the first request.
+    run_prefork(args.workers, lambda idx: serve(shard_log_path(log_path, idx), {**meta, "worker": idx}))
 
 
 if __name__ == "__main__":
@@ -5,6 +5,11 @@ from typing import Dict
 from dotenv import load_dotenv
 
 
+def env_flag(name: str, default: str = "0") -> bool:
+    """True when the environment variable is set to 1/true/yes/on."""
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
 @dataclass(frozen=True)
 class Counts:
     count_100b: int
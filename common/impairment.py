@@ -0,0 +1,50 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
+
+@dataclass(frozen=True)
+class ImpairmentProfile:
+    """Link conditions applied per direction by tools.impair_proxy.
+
+    loss and reorder are probabilities in [0, 1]; rate_kbps of 0 means no
+    bandwidth cap. burst_bytes is the token-bucket depth.
+    """
+
+    name: str
+    delay_ms: float = 0.0
+    jitter_ms: float = 0.0
+    loss: float = 0.0
+    reorder: float = 0.0
+    rate_kbps: float = 0.0
+    burst_bytes: int = 16 * 1024
+
+    def to_map(self) -> Dict[str, object]:
+        return asdict(self)
+
+
+# Built-in profiles; extra ones can be supplied as a JSON object
+# {"name": {"delay_ms": ..., ...}, ...} via IMPAIRMENT_PROFILES_FILE.
+PROFILES: Dict[str, ImpairmentProfile] = {
+    "none": ImpairmentProfile("none"),
+    "lan": ImpairmentProfile("lan", delay_ms=0.5, jitter_ms=0.2),
+    "wifi-lossy": ImpairmentProfile("wifi-lossy", delay_ms=5, jitter_ms=3, loss=0.02, reorder=0.01, rate_kbps=20000),
+    "cellular-3g": ImpairmentProfile("cellular-3g", delay_ms=100, jitter_ms=30, loss=0.01, reorder=0.005, rate_kbps=750),
+    "lpwan": ImpairmentProfile("lpwan", delay_ms=300, jitter_ms=100, loss=0.05, reorder=0.01, rate_kbps=50, burst_bytes=2048),
+    "satellite": ImpairmentProfile("satellite", delay_ms=300, jitter_ms=20, loss=0.005, rate_kbps=2000),
+}
+
+
+def load_profile(name: Optional[str] = None, profiles_file: Optional[str] = None) -> ImpairmentProfile:
+    """Resolve a profile by name (default: IMPAIRMENT_PROFILE or "none")."""
+    name = name or os.getenv("IMPAIRMENT_PROFILE", "none")
+    profiles_file = profiles_file or os.getenv("IMPAIRMENT_PROFILES_FILE")
+    profiles = dict(PROFILES)
+    if profiles_file:
+        with open(profiles_file) as f:
+            for pname, params in json.load(f).items():
+                profiles[pname] = ImpairmentProfile(name=pname, **params)
+    if name not in profiles:
+        raise SystemExit(f"Unknown impairment profile {name!r}; known: {', '.join(sorted(profiles))}")
+    return profiles[name]
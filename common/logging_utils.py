@@ -1,8 +1,22 @@
 import csv
 import os
+import socket
 import time
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+
+
+_RUN_ID: Optional[Tuple[int, str]] = None
+
+
+def run_id() -> str:
+    """Identifier of this process's run, shared by its log rows, resource
+    samples and runs.jsonl record. A forked worker gets its own."""
+    global _RUN_ID
+    pid = os.getpid()
+    if _RUN_ID is None or _RUN_ID[0] != pid:
+        _RUN_ID = (pid, f"{socket.gethostname()}-{pid}-{time.time_ns()}")
+    return _RUN_ID[1]
 
 
 @dataclass
@@ -22,8 +36,16 @@ class TransferLogEntry:
 
 
 class CsvLogger:
-    def __init__(self, log_path: str) -> None:
+    """Appends TransferLogEntry rows to a CSV file.
+
+    `tags` (e.g. the impairment profile) and the writing process's run_id
+    are merged into every row's extra_meta_json so runs under different
+    conditions stay separable and rows join to their resource samples.
+    """
+
+    def __init__(self, log_path: str, tags: Optional[Dict[str, str]] = None) -> None:
         self.log_path = log_path
+        self.tags = dict(tags or {})
         os.makedirs(os.path.dirname(log_path), exist_ok=True)
         self._ensure_header()
 
@@ -66,29 +88,57 @@ class CsvLogger:
                     entry.t_end_ns,
                     f"{entry.duration_ms:.3f}",
                     entry.bytes_sent_sender_to_receiver,
-                    json.dumps(entry.extra_meta or {}, separators=(",", ":")),
+                    json.dumps({"run_id": run_id(), **self.tags, **(entry.extra_meta or {})}, separators=(",", ":")),
                 ]
             )
 
 
+def write_run_meta(log_dir: str, protocol: str, role: str, meta: Optional[Dict[str, object]] = None) -> None:
+    """Append one JSON line describing this process/run to {log_dir}/runs.jsonl."""
+    import json
+    import sys
+
+    os.makedirs(log_dir, exist_ok=True)
+    record = {
+        "run_id": run_id(),
+        "protocol": protocol,
+        "role": role,
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "wall_time_ns": time.time_ns(),
+        "monotonic_ns": time.monotonic_ns(),
+        "argv": sys.argv[1:],
+    }
+    record.update(meta or {})
+    with open(os.path.join(log_dir, "runs.jsonl"), "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
 def monotonic_ns() -> int:
     return time.monotonic_ns()
 
 
-def estimate_mqtt_publish_overhead_bytes(topic: str, payload_len: int, qos: int) -> int:
-    # MQTT v3.1.1 PUBLISH header estimation: Fixed header + variable header + topic length
-    # Fixed header: 2+ bytes (remaining length varint). We'll estimate conservatively.
+def _mqtt_varint_len(value: int) -> int:
+    # Variable byte integer (remaining length / property length): 1-4 bytes
+    if value < 128:
+        return 1
+    elif value < 16384:
+        return 2
+    elif value < 2097152:
+        return 3
+    return 4
+
+
+def estimate_mqtt_publish_overhead_bytes(topic: str, payload_len: int, qos: int, properties_len: Optional[int] = None) -> int:
+    # MQTT PUBLISH size: fixed header + variable header + payload
+    # Fixed header: 1 byte + remaining length varint (1-4 bytes).
     # Variable header: topic length (2 bytes) + topic + (QoS>0) packet identifier (2 bytes)
-    remaining_len = 2 + len(topic) + (2 if qos > 0 else 0) + payload_len
-    # Remaining length field is 1-4 bytes depending on size
-    if remaining_len < 128:
-        rem_len_len = 1
-    elif remaining_len < 16384:
-        rem_len_len = 2
-    elif remaining_len < 2097152:
-        rem_len_len = 3
-    else:
-        rem_len_len = 4
-    fixed_header = 1 + rem_len_len
-    variable_header = 2 + len(topic) + (2 if qos > 0 else 0)
+    # MQTT v5 only: + property length varint + properties. properties_len is the
+    # encoded size of the properties themselves (None means v3.1.1, no field).
+    # With a v5 topic alias the topic may be "" and the alias is in properties.
+    variable_header = 2 + len(topic.encode("utf-8")) + (2 if qos > 0 else 0)
+    if properties_len is not None:
+        variable_header += _mqtt_varint_len(properties_len) + properties_len
+    remaining_len = variable_header + payload_len
+    fixed_header = 1 + _mqtt_varint_len(remaining_len)
     return fixed_header + variable_header + payload_len
@@ -0,0 +1,90 @@
+import os
+import re
+import signal
+import sys
+import time
+import traceback
+from typing import Callable, Dict
+
+# Seconds to wait before respawning a crashed worker, so a worker that dies on
+# startup (e.g. bind failure) does not turn into a fork loop.
+RESTART_DELAY_S = 0.5
+
+SHARD_RE = re.compile(r"^(.+)-w(\d+)\.csv$")
+
+
+def shard_log_path(log_path: str, worker: int) -> str:
+    """server.csv -> server-w{worker}.csv; merged back by tools.aggregate_results."""
+    base, ext = os.path.splitext(log_path)
+    return f"{base}-w{worker}{ext}"
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _spawn(worker: int, target: Callable[[int], None]) -> int:
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    # Child: run the worker and never return into the supervisor loop. SIGTERM
+    # takes the Ctrl-C path so workers flush logs/traces in their finally blocks.
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    code = 0
+    try:
+        target(worker)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+
+def run_prefork(workers: int, target: Callable[[int], None]) -> None:
+    """Fork `workers` processes each running target(worker_index).
+
+    Workers are expected to bind their own listening socket with SO_REUSEPORT
+    so the kernel spreads connections/datagrams across them. The calling
+    process stays as supervisor: workers that die abnormally are restarted
+    with the same index; a clean exit is not restarted. SIGINT/SIGTERM stop
+    all workers.
+    """
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    for worker in range(workers):
+        children[_spawn(worker, target)] = worker
+
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except KeyboardInterrupt:
+                _stop(signal.SIGINT, None)
+                continue
+            worker = children.pop(pid, None)
+            if worker is None or stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0:
+                print(f"worker {worker} (pid {pid}) exited with {code}; restarting", file=sys.stderr)
+                time.sleep(RESTART_DELAY_S)
+                children[_spawn(worker, target)] = worker
+    finally:
+        _stop(signal.SIGTERM, None)
@@ -0,0 +1,190 @@
+import csv
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from common.config import env_flag
+from common.logging_utils import run_id
+
+SAMPLE_COLUMNS = [
+    "run_id",
+    "name",
+    "protocol",
+    "role",
+    "host",
+    "pid",
+    "t_ns",
+    "cpu_ns",
+    "utime_ns",
+    "stime_ns",
+    "rss_bytes",
+    "hwm_bytes",
+    "threads",
+    "vol_ctx",
+    "invol_ctx",
+    "syscr",
+    "syscw",
+    "rchar",
+    "wchar",
+    "socket_fds",
+    "tcp_in_segs",
+    "tcp_out_segs",
+    "tcp_retrans_segs",
+    "udp_in_datagrams",
+    "udp_out_datagrams",
+    "udp_rcvbuf_errors",
+]
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _read_kv(path: str) -> Dict[str, str]:
+    # "Key:   value [kB]" lines (/proc/self/status) or "key: value" (/proc/self/io)
+    out: Dict[str, str] = {}
+    for line in (_read(path) or "").splitlines():
+        key, _, value = line.partition(":")
+        if value:
+            out[key.strip()] = value.strip()
+    return out
+
+
+def _kb(value: Optional[str]) -> Optional[int]:
+    return int(value.split()[0]) * 1024 if value else None
+
+
+def _read_snmp() -> Dict[str, int]:
+    # /proc/self/net/snmp: pairs of "Proto: names..." / "Proto: values..." lines.
+    # These counters are per network namespace, not per process.
+    lines = (_read("/proc/self/net/snmp") or "").splitlines()
+    out: Dict[str, int] = {}
+    for names, values in zip(lines[::2], lines[1::2]):
+        proto, _, names = names.partition(":")
+        for k, v in zip(names.split(), values.partition(":")[2].split()):
+            out[f"{proto}.{k}"] = int(v)
+    return out
+
+
+def _count_socket_fds() -> Optional[int]:
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    n = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                n += 1
+        except OSError:
+            pass
+    return n
+
+
+def read_sample() -> Dict[str, Optional[int]]:
+    """One snapshot of this process's counters. Fields /proc does not provide are None."""
+    sample: Dict[str, Optional[int]] = {
+        "t_ns": time.monotonic_ns(),
+        # CLOCK_PROCESS_CPUTIME_ID: all threads, ns resolution (stat ticks are 10 ms)
+        "cpu_ns": time.process_time_ns(),
+    }
+    stat = _read("/proc/self/stat")
+    if stat:
+        # Fields after the ")" that closes comm; utime/stime are fields 14/15
+        fields = stat.rpartition(")")[2].split()
+        sample["utime_ns"] = int(fields[11]) * 1_000_000_000 // _CLK_TCK
+        sample["stime_ns"] = int(fields[12]) * 1_000_000_000 // _CLK_TCK
+    status = _read_kv("/proc/self/status")
+    sample["rss_bytes"] = _kb(status.get("VmRSS"))
+    sample["hwm_bytes"] = _kb(status.get("VmHWM"))
+    for col, key in (("threads", "Threads"), ("vol_ctx", "voluntary_ctxt_switches"), ("invol_ctx", "nonvoluntary_ctxt_switches")):
+        sample[col] = int(status[key]) if key in status else None
+    io = _read_kv("/proc/self/io")
+    for key in ("syscr", "syscw", "rchar", "wchar"):
+        sample[key] = int(io[key]) if key in io else None
+    sample["socket_fds"] = _count_socket_fds()
+    snmp = _read_snmp()
+    for col, key in (
+        ("tcp_in_segs", "Tcp.InSegs"),
+        ("tcp_out_segs", "Tcp.OutSegs"),
+        ("tcp_retrans_segs", "Tcp.RetransSegs"),
+        ("udp_in_datagrams", "Udp.InDatagrams"),
+        ("udp_out_datagrams", "Udp.OutDatagrams"),
+        ("udp_rcvbuf_errors", "Udp.RcvbufErrors"),
+    ):
+        sample[col] = snmp.get(key)
+    return sample
+
+
+class ResourceSampler:
+    """Background thread sampling CPU, memory, context switches and socket counters.
+
+    Enabled with SAMPLE=1; SAMPLE_INTERVAL_MS sets the period (default 100).
+    Each sample is appended to {LOG_DIR}/samples/{name}-{pid}.csv as it is taken,
+    keyed by run_id, so a killed process still leaves its samples behind.
+    aggregate_results joins them to transfer windows via monotonic timestamps.
+    syscr/syscw count the read()/write() family only (not send/recv), and the
+    Tcp/Udp counters are per network namespace. The sampler's own reads are
+    included in the process's CPU time.
+    """
+
+    def __init__(self, name: str, protocol: str, role: str, out_dir: str, interval_s: float, enabled: bool) -> None:
+        self.name = name
+        self.protocol = protocol
+        self.role = role
+        self.out_dir = out_dir
+        self.interval_s = interval_s
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self.run_id = run_id()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._writer = None
+
+    @classmethod
+    def from_env(cls, name: str, protocol: str, role: str, log_dir: str) -> "ResourceSampler":
+        interval_s = float(os.getenv("SAMPLE_INTERVAL_MS", "100")) / 1000.0
+        return cls(name, protocol, role, os.path.join(log_dir, "samples"), interval_s, env_flag("SAMPLE"))
+
+    def start(self) -> "ResourceSampler":
+        if not self.enabled or self._thread is not None:
+            return self
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"{self.name}-{self.pid}.csv")
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(SAMPLE_COLUMNS)
+        self._write(read_sample())
+        self._thread = threading.Thread(target=self._run, name=f"sampler-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def _write(self, sample: Dict[str, Optional[int]]) -> None:
+        row: List[object] = [self.run_id, self.name, self.protocol, self.role, self.host, self.pid]
+        row.extend("" if sample.get(col) is None else sample[col] for col in SAMPLE_COLUMNS[6:])
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self._write(read_sample())
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        # Closing sample so the last transfer window is fully covered
+        self._write(read_sample())
+        self._file.close()
+        self._thread = None
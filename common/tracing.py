@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional, TextIO
+
+from common.config import env_flag
+
+
+# Returned by span() when tracing is off: no generator, no allocation
+_NOOP_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "t0")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict[str, object]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> None:
+        self.t0 = time.monotonic_ns()
+
+    def __exit__(self, *exc: object) -> None:
+        t1 = time.monotonic_ns()
+        self.tracer._record((self.name, "X", self.t0, t1 - self.t0, threading.get_ident(), self.args))
+
+
+class Tracer:
+    """Collects per-phase spans and writes them as Chrome/Perfetto trace JSON.
+
+    Enabled with TRACE=1. Events are buffered (one tuple each) and appended to
+    {TRACE_DIR or LOG_DIR/traces}/{name}-{pid}.json every FLUSH_EVERY events
+    or FLUSH_INTERVAL_NS, and on close(), in the JSON array trace format, which loads directly in
+    chrome://tracing or ui.perfetto.dev even when the process was killed
+    before closing it. When disabled, span() returns a shared no-op context
+    manager. Code timing a transfer records its phases with add_span() after
+    the measured window instead of wrapping it in span().
+    """
+
+    FLUSH_EVERY = 10000
+    FLUSH_INTERVAL_NS = 5_000_000_000
+
+    def __init__(self, name: str, out_dir: str, enabled: bool) -> None:
+        self.name = name
+        self.out_dir = out_dir
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self._events: List[tuple] = []
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+        self._last_flush_ns = time.monotonic_ns()
+
+    @classmethod
+    def from_env(cls, name: str, log_dir: str) -> "Tracer":
+        out_dir = os.getenv("TRACE_DIR") or os.path.join(log_dir, "traces")
+        return cls(name, out_dir, env_flag("TRACE"))
+
+    def span(self, name: str, **args: object) -> ContextManager[None]:
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name, args)
+
+    def mark(self, name: str, t_ns: Optional[int] = None, **args: object) -> None:
+        """Record an instant event, e.g. first/last byte of a response."""
+        if self.enabled:
+            self._record((name, "i", t_ns or time.monotonic_ns(), 0, threading.get_ident(), args))
+
+    def add_span(self, name: str, t_start_ns: int, t_end_ns: int, **args: object) -> None:
+        """Record a span whose bounds were measured elsewhere (e.g. across callbacks)."""
+        if self.enabled:
+            self._record((name, "X", t_start_ns, t_end_ns - t_start_ns, threading.get_ident(), args))
+
+    def _record(self, event: tuple) -> None:
+        self._events.append(event)
+        # event[2] is the event's own timestamp; saves a clock read per event
+        if len(self._events) >= self.FLUSH_EVERY or event[2] - self._last_flush_ns >= self.FLUSH_INTERVAL_NS:
+            self.flush()
+
+    def _to_chrome(self, event: tuple) -> Dict[str, object]:
+        name, ph, t_ns, dur_ns, tid, args = event
+        ev: Dict[str, object] = {"name": name, "ph": ph, "ts": t_ns / 1e3, "pid": self.pid, "tid": tid}
+        if ph == "X":
+            ev["dur"] = dur_ns / 1e3
+        else:
+            ev["s"] = "t"
+        if args:
+            ev["args"] = {k: str(v) for k, v in args.items()}
+        return ev
+
+    def flush(self) -> None:
+        with self._lock:
+            self._last_flush_ns = time.monotonic_ns()
+            # Slice + del are atomic under the GIL, so events appended by other
+            # threads meanwhile stay queued for the next flush
+            n = len(self._events)
+            events = self._events[:n]
+            del self._events[:n]
+            if not events:
+                return
+            if self._file is None:
+                os.makedirs(self.out_dir, exist_ok=True)
+                self._file = open(os.path.join(self.out_dir, f"{self.name}-{self.pid}.json"), "w")
+                meta = {"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": self.name}}
+                self._file.write("[" + json.dumps(meta))
+            for event in events:
+                self._file.write(",\n" + json.dumps(self._to_chrome(event)))
+            self._file.flush()
+
+    def close(self) -> Optional[str]:
+        if not self.enabled:
+            return None
+        self.flush()
+        with self._lock:
+            if self._file is None:
+                return None
+            self._file.write("]\n")
+            self._file.close()
+            path, self._file = self._file.name, None
+        return path
+
+
+@contextmanager
+def profile_segment(segment: str, name: str, log_dir: str) -> Iterator[None]:
+    """Run cProfile or tracemalloc around one run segment when requested.
+
+    PROFILE=cprofile|tracemalloc selects the profiler; PROFILE_SEGMENT limits it
+    to one segment (a file name for clients/publishers, "serve" for servers).
+    Results go to {LOG_DIR}/profiles/{name}-{segment}.prof (pstats) or
+    .tracemalloc.txt (top allocations by line).
+    """
+    mode = os.getenv("PROFILE", "").strip().lower()
+    wanted = os.getenv("PROFILE_SEGMENT")
+    if mode not in ("cprofile", "tracemalloc") or (wanted and wanted != segment):
+        yield
+        return
+
+    out_dir = os.path.join(log_dir, "profiles")
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, f"{name}-{segment}")
+
+    if mode == "cprofile":
+        import cProfile
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(f"{base}.prof")
+    else:
+        import tracemalloc
+
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(f"{base}.tracemalloc.txt", "w") as f:
+                f.write(f"current_bytes={current} peak_bytes={peak}\n")
+                for stat in snapshot.statistics("lineno")[:50]:
+                    f.write(f"{stat}\n")
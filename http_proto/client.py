@@ -1,61 +1,238 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import socket
 import uuid
+from collections import deque
+from typing import Deque, Optional, Tuple
+
 import requests
 
 from common.config import Settings
-from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns
+from common.impairment import load_profile
+from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns, write_run_meta
 from common.fileset import discover_files_by_size, build_iterations_by_filename
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--files-dir", default="DataFiles")
-    args = parser.parse_args()
+def run_file(session, host, port, file_name, iterations, logger, tracer: Tracer) -> None:
+    for i in range(1, iterations + 1):
+        seq = str(uuid.uuid4())
+        url = f"http://{host}:{port}/files/{file_name}?seq={seq}&iter={i}"
+        t0 = monotonic_ns()
+        # stream=True returns once the headers are in, which marks first byte;
+        # reading .content then drains the body exactly as a non-streamed get.
+        r = session.get(url, stream=True)
+        t_first = monotonic_ns()
+        r.raise_for_status()
+        payload = r.content
+        t1 = monotonic_ns()
+        duration_ms = (t1 - t0) / 1e6
 
-    settings = Settings.load()
-    host = settings.endpoints.http_host
-    port = settings.endpoints.http_port
+        if tracer.enabled:
+            tracer.add_span("request", t0, t_first, file=file_name, iter=i)
+            tracer.mark("first_byte", t_first, file=file_name)
+            tracer.add_span("body", t_first, t1, file=file_name, bytes=len(payload))
+            tracer.mark("last_byte", t1, file=file_name)
 
-    os.makedirs(os.path.join(settings.log_dir, "http"), exist_ok=True)
-    logger = CsvLogger(os.path.join(settings.log_dir, "http", "client.csv"))
+        with tracer.span("log_write"):
+            logger.write(
+                TransferLogEntry(
+                    protocol="http",
+                    role="client",
+                    file_name=file_name,
+                    file_size_bytes=len(payload),
+                    iteration=i,
+                    seq_id=seq,
+                    qos_or_mode="http",
+                    t_start_ns=t0,
+                    t_end_ns=t1,
+                    duration_ms=duration_ms,
+                    bytes_sent_sender_to_receiver=len(payload),
+                    extra_meta=None,
+                )
+            )
 
-    selected = discover_files_by_size(args.files_dir)
-    if len(selected) < 4:
-        raise SystemExit("Expected 4 files in DataFiles with sizes 100B, 10KB, 1MB, 10MB")
-    counts_by_name = build_iterations_by_filename(selected, settings.counts.to_map())
 
-    session = requests.Session()
+class RawHttpConnection:
+    """Persistent HTTP/1.1 connection on a plain socket with a reused receive buffer.
+
+    Responses are parsed just far enough to find the status and Content-Length;
+    bodies are received in place into one buffer that only grows to the largest
+    response seen. Bytes past the current response (the next pipelined
+    response) stay in the buffer for the following read_response().
+    """
+
+    def __init__(self, host: str, port: int, bufsize: int = 1 << 16) -> None:
+        self.host = host
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0  # unread data is buf[start:end]
+        self.end = 0
 
-    for file_name, iterations in counts_by_name.items():
-        for i in range(1, iterations + 1):
+    def connect(self) -> None:
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.start = self.end = 0
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, data: bytes) -> None:
+        # Connects lazily so reconnects after "Connection: close" are timed
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(data)
+
+    def _fill(self, need: int) -> None:
+        """Receive until buf[start:end] holds at least `need` bytes."""
+        while self.end - self.start < need:
+            if len(self.buf) - self.start < need:
+                pending = bytes(self.view[self.start:self.end])
+                if need > len(self.buf):
+                    self.view.release()
+                    self.buf = bytearray(max(need, 2 * len(self.buf)))
+                    self.view = memoryview(self.buf)
+                self.buf[:len(pending)] = pending
+                self.start, self.end = 0, len(pending)
+            n = self.sock.recv_into(self.view[self.end:])
+            if not n:
+                raise ConnectionError(f"{self.host}:{self.port} closed the connection")
+            self.end += n
+
+    def read_response(self) -> Tuple[int, int, bool, int]:
+        """Returns (status, body length, connection reusable, headers-complete ns)."""
+        scanned = 0
+        while True:
+            i = self.buf.find(b"\r\n\r\n", self.start + max(scanned - 3, 0), self.end)
+            if i >= 0:
+                break
+            scanned = self.end - self.start
+            self._fill(scanned + 1)
+        t_first = monotonic_ns()
+        head = bytes(self.view[self.start:i]).lower()
+        status = int(head[9:12])
+        cl = head.find(b"\r\ncontent-length:")
+        if cl < 0:
+            raise ConnectionError(f"HTTP {status} response without Content-Length")
+        eol = head.find(b"\r\n", cl + 2)
+        body_len = int(head[cl + 17:eol if eol > 0 else None])
+        keep_alive = head.startswith(b"http/1.1") and b"\r\nconnection: close" not in head
+
+        self.start = i + 4
+        self._fill(body_len)
+        self.start += body_len
+        if self.start == self.end:
+            self.start = self.end = 0
+        return status, body_len, keep_alive, t_first
+
+
+def run_file_raw(conn: RawHttpConnection, host, port, file_name, iterations, logger, tracer: Tracer, pipeline: int = 1) -> None:
+    # Everything but seq/iter is encoded once per file
+    prefix = f"GET /files/{file_name}?seq=".encode()
+    suffix = f" HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode()
+    mode = "http-raw" if pipeline <= 1 else f"http-raw-p{pipeline}"
+    outstanding: Deque[Tuple[str, int, int]] = deque()
+    next_i = 1
+    while next_i <= iterations or outstanding:
+        # Top the pipeline up to `pipeline` in-flight requests with one send
+        batch = []
+        while next_i <= iterations and len(outstanding) + len(batch) < pipeline:
             seq = str(uuid.uuid4())
-            url = f"http://{host}:{port}/files/{file_name}?seq={seq}&iter={i}"
+            batch.append((seq, next_i, b"".join((prefix, seq.encode(), b"&iter=", str(next_i).encode(), suffix))))
+            next_i += 1
+        if batch:
             t0 = monotonic_ns()
-            r = session.get(url)
-            r.raise_for_status()
-            payload = r.content
-            t1 = monotonic_ns()
-            duration_ms = (t1 - t0) / 1e6
+            conn.send(b"".join(req for _, _, req in batch))
+            outstanding.extend((seq, i, t0) for seq, i, _ in batch)
+
+        seq, i, t0 = outstanding.popleft()
+        status, body_len, keep_alive, t_first = conn.read_response()
+        t1 = monotonic_ns()
+        if status != 200:
+            raise ConnectionError(f"GET /files/{file_name}: HTTP {status}")
+        if not keep_alive:
+            conn.close()
+            if outstanding:
+                raise SystemExit("Server closed the connection with requests in flight; "
+                                 "run http_proto.server with --keep-alive to pipeline")
+        duration_ms = (t1 - t0) / 1e6
 
+        if tracer.enabled:
+            tracer.add_span("request", t0, t_first, file=file_name, iter=i)
+            tracer.mark("first_byte", t_first, file=file_name)
+            tracer.add_span("body", t_first, t1, file=file_name, bytes=body_len)
+            tracer.mark("last_byte", t1, file=file_name)
+
+        with tracer.span("log_write"):
             logger.write(
                 TransferLogEntry(
                     protocol="http",
                     role="client",
                     file_name=file_name,
-                    file_size_bytes=len(payload),
+                    file_size_bytes=body_len,
                     iteration=i,
                     seq_id=seq,
-                    qos_or_mode="http",
+                    qos_or_mode=mode,
                     t_start_ns=t0,
                     t_end_ns=t1,
                     duration_ms=duration_ms,
-                    bytes_sent_sender_to_receiver=len(payload),
+                    bytes_sent_sender_to_receiver=body_len,
                     extra_meta=None,
                 )
             )
 
 
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files-dir", default="DataFiles")
+    parser.add_argument("--engine", choices=["requests", "raw"], default="requests",
+                        help="raw: persistent socket with prebuilt requests; logged as mode http-raw[-pN]")
+    parser.add_argument("--pipeline", type=int, default=1,
+                        help="raw engine: HTTP/1.1 requests kept in flight (needs server --keep-alive)")
+    args = parser.parse_args()
+    if args.pipeline < 1:
+        parser.error("--pipeline must be at least 1")
+    if args.pipeline > 1 and args.engine != "raw":
+        parser.error("--pipeline needs --engine raw")
+
+    settings = Settings.load()
+    host = settings.endpoints.http_host
+    port = settings.endpoints.http_port
+
+    os.makedirs(os.path.join(settings.log_dir, "http"), exist_ok=True)
+    profile = load_profile()
+    logger = CsvLogger(os.path.join(settings.log_dir, "http", "client.csv"), tags={"impairment": profile.name})
+    write_run_meta(settings.log_dir, "http", "client", {"impairment": profile.to_map(), "engine": args.engine, "pipeline": args.pipeline})
+
+    selected = discover_files_by_size(args.files_dir)
+    if len(selected) < 4:
+        raise SystemExit("Expected 4 files in DataFiles with sizes 100B, 10KB, 1MB, 10MB")
+    counts_by_name = build_iterations_by_filename(selected, settings.counts.to_map())
+
+    session = requests.Session() if args.engine == "requests" else None
+    conn = RawHttpConnection(host, port) if args.engine == "raw" else None
+    tracer = Tracer.from_env("http-client", settings.log_dir)
+    sampler = ResourceSampler.from_env("http-client", "http", "client", settings.log_dir).start()
+
+    try:
+        for file_name, iterations in counts_by_name.items():
+            with profile_segment(file_name, "http-client", settings.log_dir):
+                if conn is not None:
+                    run_file_raw(conn, host, port, file_name, iterations, logger, tracer, args.pipeline)
+                else:
+                    run_file(session, host, port, file_name, iterations, logger, tracer)
+    finally:
+        if conn is not None:
+            conn.close()
+        sampler.stop()
+        tracer.close()
+
+
 if __name__ == "__main__":
     main()
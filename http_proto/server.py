@@ -4,11 +4,16 @@ import os
 import socket
 import time
 import uuid
+from typing import Dict, Optional
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, parse_qs
 
 from common.config import Settings
-from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns
+from common.impairment import load_profile
+from common.logging_utils import CsvLogger, TransferLogEntry, monotonic_ns, write_run_meta
+from common.prefork import run_prefork, shard_log_path
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
 
 
 class FileHandler(BaseHTTPRequestHandler):
@@ -18,6 +23,7 @@ class FileHandler(BaseHTTPRequestHandler):
         settings: Settings = self.server.settings  # type: ignore[attr-defined]
         files_dir = self.server.files_dir  # type: ignore[attr-defined]
         logger: CsvLogger = self.server.logger  # type: ignore[attr-defined]
+        tracer: Tracer = self.server.tracer  # type: ignore[attr-defined]
 
         parsed = urlparse(self.path)
         parts = parsed.path.strip("/").split("/")
@@ -35,8 +41,9 @@ class FileHandler(BaseHTTPRequestHandler):
         seq = (qs.get("seq", [str(uuid.uuid4())])[0])
         iteration = int(qs.get("iter", ["0"])[0])
 
-        with open(path, "rb") as f:
-            payload = f.read()
+        with tracer.span("file_load", file=file_name):
+            with open(path, "rb") as f:
+                payload = f.read()
 
         t0 = monotonic_ns()
         body = payload
@@ -45,10 +52,14 @@ class FileHandler(BaseHTTPRequestHandler):
         self.send_header("Content-Type", "application/octet-stream")
         self.send_header("Content-Length", str(body_len))
         self.end_headers()
+        t_headers = monotonic_ns()
         self.wfile.write(body)
         self.wfile.flush()
         t1 = monotonic_ns()
         duration_ms = (t1 - t0) / 1e6
+        if tracer.enabled:
+            tracer.add_span("serialize", t0, t_headers, file=file_name)
+            tracer.add_span("send", t_headers, t1, file=file_name, bytes=body_len)
 
         status_line = f"HTTP/1.0 200 OK\r\n"
         headers = [
@@ -60,32 +71,83 @@ class FileHandler(BaseHTTPRequestHandler):
         header_bytes = len(status_line) + sum(len(h) for h in headers) + len("\r\n")
         total_bytes = header_bytes + body_len
 
-        logger.write(
-            TransferLogEntry(
-                protocol="http",
-                role="server",
-                file_name=file_name,
-                file_size_bytes=body_len,
-                iteration=iteration,
-                seq_id=seq,
-                qos_or_mode="http",
-                t_start_ns=t0,
-                t_end_ns=t1,
-                duration_ms=duration_ms,
-                bytes_sent_sender_to_receiver=total_bytes,
-                extra_meta=None,
+        with tracer.span("log_write"):
+            logger.write(
+                TransferLogEntry(
+                    protocol="http",
+                    role="server",
+                    file_name=file_name,
+                    file_size_bytes=body_len,
+                    iteration=iteration,
+                    seq_id=seq,
+                    qos_or_mode="http",
+                    t_start_ns=t0,
+                    t_end_ns=t1,
+                    duration_ms=duration_ms,
+                    bytes_sent_sender_to_receiver=total_bytes,
+                    extra_meta=None,
+                )
             )
-        )
 
     def log_message(self, format, *args):
         return
 
 
+class KeepAliveFileHandler(FileHandler):
+    """HTTP/1.1 persistent connections, so clients can reuse or pipeline on one socket."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without TCP_NODELAY the body of a
+    # small response waits for the client's delayed ACK on a reused connection.
+    disable_nagle_algorithm = True
+
+
+class ReusePortHTTPServer(HTTPServer):
+    """HTTPServer whose listening socket can be shared by pre-forked workers."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def serve(host: str, port: int, files_dir: str, settings: Settings, log_path: str, reuse_port: bool = False, keep_alive: bool = False,
+          run_meta: Optional[Dict[str, object]] = None) -> None:
+    # Written from the serving process itself so its run_id matches its rows and samples
+    write_run_meta(settings.log_dir, "http", "server", run_meta)
+    logger = CsvLogger(log_path, tags={"impairment": load_profile().name})
+    trace_name = os.path.splitext(os.path.basename(log_path))[0]
+    tracer = Tracer.from_env(f"http-{trace_name}", settings.log_dir)
+    sampler = ResourceSampler.from_env(f"http-{trace_name}", "http", "server", settings.log_dir)
+
+    server_cls = ReusePortHTTPServer if reuse_port else HTTPServer
+    httpd = server_cls((host, port), KeepAliveFileHandler if keep_alive else FileHandler)
+    httpd.settings = settings  # type: ignore[attr-defined]
+    httpd.files_dir = files_dir  # type: ignore[attr-defined]
+    httpd.logger = logger  # type: ignore[attr-defined]
+    httpd.tracer = tracer  # type: ignore[attr-defined]
+
+    sampler.start()
+    try:
+        with profile_segment("serve", f"http-{trace_name}", settings.log_dir):
+            httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        sampler.stop()
+        tracer.close()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--files-dir", default="DataFiles")
     parser.add_argument("--host", default=None)
     parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Pre-fork N processes sharing the port via SO_REUSEPORT")
+    parser.add_argument("--keep-alive", action="store_true",
+                        help="Answer HTTP/1.1 and keep connections open (needed for client --pipeline > 1). "
+                             "Each worker serves one connection at a time.")
     args = parser.parse_args()
 
     settings = Settings.load()
@@ -93,19 +155,20 @@ def main() -> None:
     port = args.port or settings.endpoints.http_port
 
     os.makedirs(os.path.join(settings.log_dir, "http"), exist_ok=True)
-    logger = CsvLogger(os.path.join(settings.log_dir, "http", "server.csv"))
+    log_path = os.path.join(settings.log_dir, "http", "server.csv")
+    meta = {"impairment": load_profile().to_map(), "workers": args.workers, "keep_alive": args.keep_alive}
 
-    httpd = HTTPServer((host, port), FileHandler)
-    httpd.settings = settings  # type: ignore[attr-defined]
-    httpd.files_dir = args.files_dir  # type: ignore[attr-defined]
-    httpd.logger = logger  # type: ignore[attr-defined]
+    if args.workers <= 1:
+        serve(host, port, args.files_dir, settings, log_path, keep_alive=args.keep_alive, run_meta=meta)
+        return
 
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    finally:
-        httpd.server_close()
+    write_run_meta(settings.log_dir, "http", "supervisor", meta)
+
+    def worker(idx: int) -> None:
+        serve(host, port, args.files_dir, settings, shard_log_path(log_path, idx), reuse_port=True, keep_alive=args.keep_alive,
+              run_meta={**meta, "worker": idx})
+
+    run_prefork(args.workers, worker)
 
 
 if __name__ == "__main__":
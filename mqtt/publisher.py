@@ -2,20 +2,27 @@
 import argparse
 import os
 import socket
+import threading
 import time
 import uuid
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties, VariableByteIntegers
 
 from common.config import Settings
+from common.impairment import load_profile
 from common.logging_utils import (
     CsvLogger,
     TransferLogEntry,
     monotonic_ns,
     estimate_mqtt_publish_overhead_bytes,
+    write_run_meta,
 )
 from common.fileset import discover_files_by_size, build_iterations_by_filename
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
 
 
 def load_files(files_dir: str, selected: Dict[int, str]) -> Dict[str, bytes]:
@@ -27,12 +34,71 @@ def load_files(files_dir: str, selected: Dict[int, str]) -> Dict[str, bytes]:
     return files
 
 
+class TopicAliases:
+    """MQTT v5 topic aliases for stable topics, within the broker's maximum.
+
+    The first publish on a topic sends the full topic plus a new alias; later
+    publishes send an empty topic and only the alias. Topics beyond the
+    broker's Topic Alias Maximum keep using the full topic. Aliases only live
+    as long as the network connection, so reset() on every (re)connect.
+    """
+
+    def __init__(self, maximum: int = 0) -> None:
+        self.maximum = maximum
+        self._aliases: Dict[str, int] = {}
+        self._lock = threading.Lock()  # reset() runs on the network thread
+
+    def reset(self, maximum: int) -> None:
+        with self._lock:
+            self.maximum = maximum
+            self._aliases = {}
+
+    def resolve(self, topic: str) -> Tuple[str, Optional[int]]:
+        with self._lock:
+            alias = self._aliases.get(topic)
+            if alias is not None:
+                return "", alias
+            if len(self._aliases) < self.maximum:
+                alias = len(self._aliases) + 1
+                self._aliases[topic] = alias
+                return topic, alias
+            return topic, None
+
+
+def connect_v5(client: mqtt.Client, host: str, port: int, aliases: TopicAliases) -> None:
+    """Connect and wait for CONNACK, keeping aliases in step with the connection.
+
+    The broker forgets aliases when the connection drops, so they are cleared
+    on disconnect (full topics until the next CONNACK) and the map restarts
+    from the Topic Alias Maximum of every CONNACK.
+    """
+    connack = threading.Event()
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        aliases.reset(getattr(properties, "TopicAliasMaximum", 0) or 0)
+        connack.set()
+
+    def on_disconnect(client, userdata, rc, properties=None):
+        aliases.reset(0)
+
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.connect(host, port, keepalive=60)
+    client.loop_start()
+    if not connack.wait(timeout=10):
+        raise SystemExit(f"No CONNACK from broker {host}:{port}")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--qos", type=int, choices=[1, 2], required=True)
     parser.add_argument("--files-dir", default="DataFiles")
     parser.add_argument("--client-id", default=None)
+    parser.add_argument("--mqtt-version", choices=["3.1.1", "5"], default="3.1.1",
+                        help="5: stable per-file topic with topic aliases; seq/iter in properties")
     args = parser.parse_args()
+    v5 = args.mqtt_version == "5"
+    tag = f"v5_qos{args.qos}" if v5 else f"qos{args.qos}"
 
     settings = Settings.load()
     host = settings.endpoints.broker_host
@@ -42,56 +108,91 @@ def main() -> None:
     client_id = args.client_id or f"hw3-pub-{socket.gethostname()}-{os.getpid()}"
 
     os.makedirs(os.path.join(settings.log_dir, "mqtt"), exist_ok=True)
-    log_path = os.path.join(settings.log_dir, "mqtt", f"publisher_qos{args.qos}.csv")
-    logger = CsvLogger(log_path)
+    log_path = os.path.join(settings.log_dir, "mqtt", f"publisher_{tag}.csv")
+    profile = load_profile()
+    logger = CsvLogger(log_path, tags={"impairment": profile.name})
+    write_run_meta(settings.log_dir, "mqtt", "publisher", {"impairment": profile.to_map(), "qos": args.qos, "mqtt_version": args.mqtt_version})
 
     selected = discover_files_by_size(args.files_dir)
     if len(selected) < 4:
         raise SystemExit("Expected 4 files in DataFiles with sizes 100B, 10KB, 1MB, 10MB")
-    files = load_files(args.files_dir, selected)
+    tracer = Tracer.from_env(f"mqtt-publisher-{tag}", settings.log_dir)
+    sampler = ResourceSampler.from_env(f"mqtt-publisher-{tag}", "mqtt", "publisher", settings.log_dir).start()
+    with tracer.span("file_load"):
+        files = load_files(args.files_dir, selected)
     counts_by_name = build_iterations_by_filename(selected, settings.counts.to_map())
 
-    client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
-    client.connect(host, port, keepalive=60)
-    client.loop_start()
+    if v5:
+        client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        aliases = TopicAliases()
+        connect_v5(client, host, port, aliases)
+    else:
+        client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
+        client.connect(host, port, keepalive=60)
+        client.loop_start()
 
     try:
         for file_name, payload in files.items():
             iterations = counts_by_name[file_name]
-            for i in range(1, iterations + 1):
-                seq = str(uuid.uuid4())
-                topic = f"{topic_prefix}/{file_name}/{seq}"
-                t0 = monotonic_ns()
-                info = client.publish(topic, payload=payload, qos=args.qos, retain=False)
-                info.wait_for_publish()
-                t1 = monotonic_ns()
-                duration_ms = (t1 - t0) / 1e6
-
-                bytes_over_sender_to_receiver = estimate_mqtt_publish_overhead_bytes(
-                    topic=topic, payload_len=len(payload), qos=args.qos
-                )
-
-                logger.write(
-                    TransferLogEntry(
-                        protocol="mqtt",
-                        role="publisher",
-                        file_name=file_name,
-                        file_size_bytes=len(payload),
-                        iteration=i,
-                        seq_id=seq,
-                        qos_or_mode=f"qos{args.qos}",
-                        t_start_ns=t0,
-                        t_end_ns=t1,
-                        duration_ms=duration_ms,
-                        bytes_sent_sender_to_receiver=bytes_over_sender_to_receiver,
-                        extra_meta={"topic": topic},
+            with profile_segment(file_name, f"mqtt-publisher-{tag}", settings.log_dir):
+                for i in range(1, iterations + 1):
+                    seq_uuid = uuid.uuid4()
+                    seq = str(seq_uuid)
+                    props: Optional[Properties] = None
+                    props_len: Optional[int] = None
+                    alias: Optional[int] = None
+                    t0 = monotonic_ns()
+                    if v5:
+                        topic = f"{topic_prefix}/{file_name}"
+                        wire_topic, alias = aliases.resolve(topic)
+                        props = Properties(PacketTypes.PUBLISH)
+                        if alias is not None:
+                            props.TopicAlias = alias
+                        props.CorrelationData = seq_uuid.bytes
+                        props.UserProperty = ("iter", str(i))
+                    else:
+                        topic = wire_topic = f"{topic_prefix}/{file_name}/{seq}"
+                    # publish() serializes the packet and hands it to the network thread
+                    t_pub = monotonic_ns()
+                    info = client.publish(wire_topic, payload=payload, qos=args.qos, retain=False, properties=props)
+                    t_ack = monotonic_ns()
+                    info.wait_for_publish()
+                    t1 = monotonic_ns()
+                    duration_ms = (t1 - t0) / 1e6
+                    if tracer.enabled:
+                        tracer.add_span("publish", t_pub, t_ack, file=file_name, iter=i)
+                        tracer.add_span("ack_wait", t_ack, t1, file=file_name, iter=i)
+
+                    if props is not None:
+                        props_len = VariableByteIntegers.decode(props.pack())[0]
+                    bytes_over_sender_to_receiver = estimate_mqtt_publish_overhead_bytes(
+                        topic=wire_topic, payload_len=len(payload), qos=args.qos, properties_len=props_len
                     )
-                )
-                if i % 100 == 0:
-                    time.sleep(0.01)
+
+                    with tracer.span("log_write"):
+                        logger.write(
+                            TransferLogEntry(
+                                protocol="mqtt",
+                                role="publisher",
+                                file_name=file_name,
+                                file_size_bytes=len(payload),
+                                iteration=i,
+                                seq_id=seq,
+                                qos_or_mode=f"v5-qos{args.qos}" if v5 else f"qos{args.qos}",
+                                t_start_ns=t0,
+                                t_end_ns=t1,
+                                duration_ms=duration_ms,
+                                bytes_sent_sender_to_receiver=bytes_over_sender_to_receiver,
+                                extra_meta={"topic": topic, "topic_alias": str(alias)} if v5 else {"topic": topic},
+                            )
+                        )
+                    if i % 100 == 0:
+                        time.sleep(0.01)
     finally:
         client.loop_stop()
         client.disconnect()
+        sampler.stop()
+        tracer.close()
 
 
 if __name__ == "__main__":
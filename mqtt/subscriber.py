@@ -3,17 +3,23 @@ import argparse
 import os
 import re
 import socket
+import uuid
 from typing import Optional
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import VariableByteIntegers
 
 from common.config import Settings
+from common.impairment import load_profile
 from common.logging_utils import (
     CsvLogger,
     TransferLogEntry,
     monotonic_ns,
     estimate_mqtt_publish_overhead_bytes,
+    write_run_meta,
 )
+from common.sampler import ResourceSampler
+from common.tracing import Tracer, profile_segment
 
 
 TOPIC_RE = re.compile(r"^(.+)/([^/]+)/([0-9a-fA-F-]{36})$")
@@ -23,7 +29,11 @@ def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--qos", type=int, choices=[1, 2], required=True)
     parser.add_argument("--client-id", default=None)
+    parser.add_argument("--mqtt-version", choices=["3.1.1", "5"], default="3.1.1",
+                        help="5: expects seq/iter in CorrelationData/UserProperty on a per-file topic")
     args = parser.parse_args()
+    v5 = args.mqtt_version == "5"
+    tag = f"v5_qos{args.qos}" if v5 else f"qos{args.qos}"
 
     settings = Settings.load()
     host = settings.endpoints.broker_host
@@ -31,12 +41,16 @@ def main() -> None:
     topic_prefix = settings.endpoints.mqtt_topic_prefix.rstrip("/")
 
     os.makedirs(os.path.join(settings.log_dir, "mqtt"), exist_ok=True)
-    log_path = os.path.join(settings.log_dir, "mqtt", f"subscriber_qos{args.qos}.csv")
-    logger = CsvLogger(log_path)
+    log_path = os.path.join(settings.log_dir, "mqtt", f"subscriber_{tag}.csv")
+    profile = load_profile()
+    logger = CsvLogger(log_path, tags={"impairment": profile.name})
+    write_run_meta(settings.log_dir, "mqtt", "subscriber", {"impairment": profile.to_map(), "qos": args.qos, "mqtt_version": args.mqtt_version})
 
     client_id = args.client_id or f"hw3-sub-{socket.gethostname()}-{os.getpid()}"
+    tracer = Tracer.from_env(f"mqtt-subscriber-{tag}", settings.log_dir)
+    sampler = ResourceSampler.from_env(f"mqtt-subscriber-{tag}", "mqtt", "subscriber", settings.log_dir)
 
-    def on_connect(client: mqtt.Client, userdata, flags, rc):
+    def on_connect(client: mqtt.Client, userdata, flags, rc, properties=None):
         client.subscribe(f"{topic_prefix}/#", qos=args.qos)
 
     def on_message(client: mqtt.Client, userdata, msg: mqtt.MQTTMessage):
@@ -44,7 +58,17 @@ def main() -> None:
         m = TOPIC_RE.match(msg.topic)
         file_name: Optional[str] = None
         seq_id: Optional[str] = None
-        if m:
+        iteration = 0
+        props = getattr(msg, "properties", None)
+        correlation = getattr(props, "CorrelationData", None)
+        if v5 and correlation:
+            # Stable topic {prefix}/{file}; seq and iteration travel as properties
+            file_name = msg.topic.rsplit("/", 1)[-1]
+            seq_id = str(uuid.UUID(bytes=bytes(correlation)))
+            for key, value in getattr(props, "UserProperty", []):
+                if key == "iter":
+                    iteration = int(value)
+        elif m:
             file_name = m.group(2)
             seq_id = m.group(3)
         else:
@@ -54,40 +78,48 @@ def main() -> None:
                 seq_id = parts[-1]
         if file_name is None or seq_id is None:
             return
+        # paho has fully read and decoded the PUBLISH by the time on_message runs
+        tracer.mark("last_byte", t1, file=file_name)
 
         payload_len = len(msg.payload or b"")
+        props_len = VariableByteIntegers.decode(props.pack())[0] if v5 and props is not None else None
         bytes_over_sender_to_receiver = estimate_mqtt_publish_overhead_bytes(
-            topic=msg.topic, payload_len=payload_len, qos=args.qos
+            topic=msg.topic, payload_len=payload_len, qos=args.qos, properties_len=props_len
         )
 
-        logger.write(
-            TransferLogEntry(
-                protocol="mqtt",
-                role="subscriber",
-                file_name=file_name,
-                file_size_bytes=payload_len,
-                iteration=0,
-                seq_id=seq_id,
-                qos_or_mode=f"qos{args.qos}",
-                t_start_ns=t1,
-                t_end_ns=t1,
-                duration_ms=0.0,
-                bytes_sent_sender_to_receiver=bytes_over_sender_to_receiver,
-                extra_meta={"topic": msg.topic},
+        with tracer.span("log_write"):
+            logger.write(
+                TransferLogEntry(
+                    protocol="mqtt",
+                    role="subscriber",
+                    file_name=file_name,
+                    file_size_bytes=payload_len,
+                    iteration=iteration,
+                    seq_id=seq_id,
+                    qos_or_mode=f"v5-qos{args.qos}" if v5 else f"qos{args.qos}",
+                    t_start_ns=t1,
+                    t_end_ns=t1,
+                    duration_ms=0.0,
+                    bytes_sent_sender_to_receiver=bytes_over_sender_to_receiver,
+                    extra_meta={"topic": msg.topic},
+                )
             )
-        )
 
-    client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
+    client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
     client.on_connect = on_connect
     client.on_message = on_message
 
     client.connect(host, port, keepalive=60)
+    sampler.start()
     try:
-        client.loop_forever()
+        with profile_segment("serve", f"mqtt-subscriber-{tag}", settings.log_dir):
+            client.loop_forever()
     except KeyboardInterrupt:
         pass
     finally:
         client.disconnect()
+        sampler.stop()
+        tracer.close()
 
 
 if __name__ == "__main__":
@@ -1,23 +1,49 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import os
+import numpy as np
 import pandas as pd
-from typing import Dict
+from typing import Dict, List, Tuple
+
+from common.prefork import SHARD_RE
+
+# Runs from before rows were tagged had no impairment proxy in front of them
+DEFAULT_IMPAIRMENT = "none"
 
 
 def load_csvs(log_dir: str) -> Dict[str, pd.DataFrame]:
-    dfs = {}
+    """Load every log CSV keyed by "{proto}/{name}".
+    Per-worker shards (server-w0.csv, server-w1.csv, ...) are merged under their base name.
+    The impairment profile and run id tagged into extra_meta_json become
+    `impairment` and `run_id` columns.
+    """
+    parts: Dict[str, List[pd.DataFrame]] = {}
     for proto in ["mqtt", "coap", "http"]:
         pdir = os.path.join(log_dir, proto)
         if not os.path.isdir(pdir):
             continue
-        for name in os.listdir(pdir):
+        for name in sorted(os.listdir(pdir)):
             if name.endswith(".csv"):
-                key = f"{proto}/{name}"
-                dfs[key] = pd.read_csv(os.path.join(pdir, name))
+                m = SHARD_RE.match(name)
+                key = f"{proto}/{m.group(1)}.csv" if m else f"{proto}/{name}"
+                parts.setdefault(key, []).append(pd.read_csv(os.path.join(pdir, name)))
+    dfs = {k: pd.concat(v, ignore_index=True) for k, v in parts.items()}
+    for df in dfs.values():
+        meta = df.get("extra_meta_json", pd.Series("{}", index=df.index)).fillna("{}").map(json.loads)
+        df["impairment"] = meta.map(lambda m: m.get("impairment", DEFAULT_IMPAIRMENT))
+        df["run_id"] = meta.map(lambda m: m.get("run_id"))
     return dfs
 
 
+def load_run_meta(log_dir: str) -> pd.DataFrame:
+    """One row per process start from runs.jsonl (impairment profile, argv, ...)."""
+    path = os.path.join(log_dir, "runs.jsonl")
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.json_normalize(pd.read_json(path, lines=True).to_dict(orient="records"))
+
+
 def merge_mqtt(dfs: Dict[str, pd.DataFrame]) -> pd.DataFrame:
     pubs = [v for k, v in dfs.items() if k.startswith("mqtt/") and "publisher" in k]
     subs = [v for k, v in dfs.items() if k.startswith("mqtt/") and "subscriber" in k]
@@ -28,7 +54,7 @@ def merge_mqtt(dfs: Dict[str, pd.DataFrame]) -> pd.DataFrame:
     pub = pub.rename(columns={"bytes_sent_sender_to_receiver": "bytes_pub"})
     sub = sub.rename(columns={"bytes_sent_sender_to_receiver": "bytes_sub"})
     # Join on seq_id
-    merged = pd.merge(pub, sub[["seq_id", "file_name", "t_start_ns", "bytes_sub"]], on=["seq_id", "file_name"], how="inner", suffixes=("_pub", "_sub"))
+    merged = pd.merge(pub, sub[["seq_id", "file_name", "file_size_bytes", "t_start_ns", "bytes_sub"]], on=["seq_id", "file_name"], how="inner", suffixes=("_pub", "_sub"))
     # Receiver time as sub.t_start_ns; compute latency and throughput
     merged["end_ns_receiver"] = merged["t_start_ns_sub"]
     merged["duration_ms"] = (merged["end_ns_receiver"] - merged["t_start_ns_pub"]) / 1e6
@@ -42,7 +68,13 @@ def summarize(df: pd.DataFrame, label_file_size_col: str) -> pd.DataFrame:
     if df.empty:
         return df
     df["file_size"] = df[label_file_size_col]
-    summary = df.groupby(["protocol_pub" if "protocol_pub" in df.columns else "protocol", "file_name"]).agg(
+    keys = ["protocol_pub" if "protocol_pub" in df.columns else "protocol", "file_name"]
+    if "qos_or_mode" in df.columns:
+        # keep e.g. qos1 vs v5-qos1 or con-block vs tcp-bert apart
+        keys.insert(1, "qos_or_mode")
+    if "impairment" in df.columns:
+        keys.insert(1, "impairment")
+    summary = df.groupby(keys).agg(
         count=("seq_id", "count"),
         avg_ms=("duration_ms", "mean"),
         median_ms=("duration_ms", "median"),
@@ -53,6 +85,122 @@ def summarize(df: pd.DataFrame, label_file_size_col: str) -> pd.DataFrame:
     return summary
 
 
+def _with_rates(client_df: pd.DataFrame) -> pd.DataFrame:
+    df = client_df.copy()
+    df["throughput_bps"] = df["file_size_bytes"] * 8 / (df["duration_ms"] / 1000.0).clip(lower=1e-9)
+    df["overhead_ratio"] = df["bytes_sent_sender_to_receiver"] / df["file_size_bytes"].replace(0, pd.NA)
+    return df
+
+
+def transfer_events(dfs: Dict[str, pd.DataFrame]) -> Dict[str, Tuple[pd.DataFrame, str]]:
+    """End-to-end events per protocol view: name -> (events, file size column).
+    MQTT joins publisher and subscriber; CoAP and HTTP use client timing for E2E.
+    """
+    events: Dict[str, Tuple[pd.DataFrame, str]] = {}
+    mqtt = merge_mqtt(dfs)
+    if not mqtt.empty:
+        mqtt["throughput_bps"] = mqtt["throughput_bps"].astype(float)
+        mqtt["overhead_ratio"] = mqtt["overhead_ratio"].astype(float)
+        events["MQTT"] = (mqtt, "file_size_bytes_pub")
+    # Observe mode: push notifications, duration is server publish -> client receive
+    for name, key in (("CoAP", "coap/client.csv"), ("CoAP_Observe", "coap/observer.csv"), ("HTTP", "http/client.csv")):
+        client = dfs.get(key)
+        if client is not None and not client.empty:
+            events[name] = (_with_rates(client), "file_size_bytes")
+    return events
+
+
+def load_samples(log_dir: str) -> pd.DataFrame:
+    """Resource samples written by common.sampler, one CSV per sampled process."""
+    sdir = os.path.join(log_dir, "samples")
+    if not os.path.isdir(sdir):
+        return pd.DataFrame()
+    frames = [pd.read_csv(os.path.join(sdir, n)) for n in sorted(os.listdir(sdir)) if n.endswith(".csv")]
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _union(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge possibly overlapping [start, end] windows into disjoint segments."""
+    order = np.argsort(starts)
+    s = starts[order]
+    reach = np.maximum.accumulate(ends[order])
+    new = np.r_[True, s[1:] > reach[:-1]]
+    last = np.r_[np.flatnonzero(new)[1:] - 1, len(s) - 1]
+    return s[new], reach[last]
+
+
+def resource_usage(df: pd.DataFrame, size_col: str, samples: pd.DataFrame) -> pd.DataFrame:
+    """Charge each role's resource samples to transfer groups on the same host.
+
+    A group is charged once over the union of its windows, so overlapping transfers count once.
+    """
+    if df.empty or samples.empty:
+        return pd.DataFrame()
+    start_col = "t_start_ns_pub" if "t_start_ns_pub" in df.columns else "t_start_ns"
+    end_col = "end_ns_receiver" if "end_ns_receiver" in df.columns else "t_end_ns"
+    protocol = df["protocol"].iloc[0]
+    keys = ["impairment", "qos_or_mode", size_col]
+    starts = df[start_col].to_numpy(dtype=float)
+    ends = df[end_col].to_numpy(dtype=float)
+    sizes = df[size_col].to_numpy(dtype=float)
+    row_runs = df["run_id"].to_numpy() if "run_id" in df.columns else np.full(len(df), None)
+    groups = df.groupby(keys).indices
+
+    rows = []
+    for role, role_samples in samples[samples["protocol"] == protocol].groupby("role"):
+        runs = {}
+        for run_id, run in role_samples.groupby("run_id"):
+            run = run.sort_values("t_ns")
+            runs[run_id] = (run["t_ns"].to_numpy(dtype=float), {
+                "cpu_ns": run["cpu_ns"].to_numpy(dtype=float),
+                "vol_ctx": run["vol_ctx"].to_numpy(dtype=float),
+                "invol_ctx": run["invol_ctx"].to_numpy(dtype=float),
+                "rw_syscalls": (run["syscr"] + run["syscw"]).to_numpy(dtype=float),
+                "rss_bytes": run["rss_bytes"].to_numpy(dtype=float),
+            })
+        for key, idx in groups.items():
+            own = set(row_runs[idx]) & set(runs)
+            selected = [runs[r] for r in own] if own else list(runs.values())
+            seg_starts, seg_ends = _union(starts[idx], ends[idx])
+            lo, hi = seg_starts[0], seg_ends[-1]
+            charged = {m: 0.0 for m in ("cpu_ns", "vol_ctx", "invol_ctx", "rw_syscalls")}
+            peak_rss = np.nan
+            for t, series in selected:
+                for metric in charged:
+                    v = series[metric]
+                    if np.isnan(v).all():
+                        continue
+                    # Outside a run's sampled span np.interp clamps, so other runs add 0
+                    charged[metric] += (np.interp(seg_ends, t, v) - np.interp(seg_starts, t, v)).sum()
+                in_span = (t >= lo) & (t <= hi)
+                if in_span.any():
+                    rss = np.nanmax(series["rss_bytes"][in_span])
+                elif t[0] <= hi:
+                    # Group shorter than one interval: the sample just before it
+                    rss = series["rss_bytes"][np.searchsorted(t, hi, side="right") - 1]
+                else:
+                    continue
+                peak_rss = np.nanmax([peak_rss, rss])
+            n = len(idx)
+            kb = sizes[idx].sum() / 1024.0
+            rows.append({
+                "protocol": protocol,
+                "impairment": key[0],
+                "qos_or_mode": key[1],
+                "file_size_bytes": key[2],
+                "role": role,
+                "count": n,
+                "cpu_ms": charged["cpu_ns"] / 1e6,
+                "cpu_us_per_kb": charged["cpu_ns"] / 1e3 / kb if kb else np.nan,
+                "peak_rss_mb": peak_rss / (1024 * 1024),
+                "vol_ctx_per_transfer": charged["vol_ctx"] / n,
+                "invol_ctx_per_transfer": charged["invol_ctx"] / n,
+                "rw_syscalls_per_transfer": charged["rw_syscalls"] / n,
+            })
+    return pd.DataFrame(rows)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--logs", default="logs")
@@ -62,49 +210,27 @@ def main() -> None:
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
 
     dfs = load_csvs(args.logs)
-
-    mqtt = merge_mqtt(dfs)
-
-    # CoAP and HTTP just concatenate client and server for summaries; use client timing for E2E
-    coap_client = dfs.get("coap/client.csv")
-    http_client = dfs.get("http/client.csv")
+    events = transfer_events(dfs)
+    runs = load_run_meta(args.logs)
+    samples = load_samples(args.logs)
+    resources = {name: resource_usage(df, size_col, samples) for name, (df, size_col) in events.items()}
 
     with pd.ExcelWriter(args.out, engine="openpyxl") as writer:
-        if not mqtt.empty:
-            mqtt["throughput_bps"] = mqtt["throughput_bps"].astype(float)
-            mqtt["overhead_ratio"] = mqtt["overhead_ratio"].astype(float)
-            mqtt.to_excel(writer, sheet_name="MQTT_Events", index=False)
-            summarize(mqtt, "file_size_bytes_pub").to_excel(writer, sheet_name="MQTT_Summary", index=False)
-        if coap_client is not None and not coap_client.empty:
-            coap_df = coap_client.copy()
-            coap_df["throughput_bps"] = coap_df["file_size_bytes"] * 8 / (coap_df["duration_ms"] / 1000.0).clip(lower=1e-9)
-            coap_df["overhead_ratio"] = coap_df["bytes_sent_sender_to_receiver"] / coap_df["file_size_bytes"].replace(0, pd.NA)
-            coap_df.to_excel(writer, sheet_name="CoAP_Events", index=False)
-            summarize(coap_df, "file_size_bytes").to_excel(writer, sheet_name="CoAP_Summary", index=False)
-        if http_client is not None and not http_client.empty:
-            http_df = http_client.copy()
-            http_df["throughput_bps"] = http_df["file_size_bytes"] * 8 / (http_df["duration_ms"] / 1000.0).clip(lower=1e-9)
-            http_df["overhead_ratio"] = http_df["bytes_sent_sender_to_receiver"] / http_df["file_size_bytes"].replace(0, pd.NA)
-            http_df.to_excel(writer, sheet_name="HTTP_Events", index=False)
-            summarize(http_df, "file_size_bytes").to_excel(writer, sheet_name="HTTP_Summary", index=False)
+        if not runs.empty:
+            runs.astype(str).to_excel(writer, sheet_name="Runs", index=False)
+        for name, (df, size_col) in events.items():
+            df.to_excel(writer, sheet_name=f"{name}_Events", index=False)
+            summarize(df, size_col).to_excel(writer, sheet_name=f"{name}_Summary", index=False)
+            if not resources[name].empty:
+                resources[name].to_excel(writer, sheet_name=f"{name}_Resources", index=False)
 
     # Also write CSV summaries
     base = os.path.splitext(args.out)[0]
-    if not mqtt.empty:
-        mqtt.to_csv(f"{base}_mqtt_events.csv", index=False)
-        summarize(mqtt, "file_size_bytes_pub").to_csv(f"{base}_mqtt_summary.csv", index=False)
-    if coap_client is not None and not coap_client.empty:
-        coap_df = coap_client.copy()
-        coap_df["throughput_bps"] = coap_df["file_size_bytes"] * 8 / (coap_df["duration_ms"] / 1000.0).clip(lower=1e-9)
-        coap_df["overhead_ratio"] = coap_df["bytes_sent_sender_to_receiver"] / coap_df["file_size_bytes"].replace(0, pd.NA)
-        coap_df.to_csv(f"{base}_coap_events.csv", index=False)
-        summarize(coap_df, "file_size_bytes").to_csv(f"{base}_coap_summary.csv", index=False)
-    if http_client is not None and not http_client.empty:
-        http_df = http_client.copy()
-        http_df["throughput_bps"] = http_df["file_size_bytes"] * 8 / (http_df["duration_ms"] / 1000.0).clip(lower=1e-9)
-        http_df["overhead_ratio"] = http_df["bytes_sent_sender_to_receiver"] / http_df["file_size_bytes"].replace(0, pd.NA)
-        http_df.to_csv(f"{base}_http_events.csv", index=False)
-        summarize(http_df, "file_size_bytes").to_csv(f"{base}_http_summary.csv", index=False)
+    for name, (df, size_col) in events.items():
+        df.to_csv(f"{base}_{name.lower()}_events.csv", index=False)
+        summarize(df, size_col).to_csv(f"{base}_{name.lower()}_summary.csv", index=False)
+        if not resources[name].empty:
+            resources[name].to_csv(f"{base}_{name.lower()}_resources.csv", index=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Compare a run's end-to-end latencies against a blessed baseline.
+
+  bless:   python -m tools.bench_compare bless --logs logs --baseline baselines/main.csv.gz
+  compare: python -m tools.bench_compare compare --logs logs --baseline baselines/main.csv.gz
+
+A scenario is (protocol, impairment, qos_or_mode, file_size_bytes). For each one the new
+duration_ms distribution is tested against the baseline with a two-sided
+Mann-Whitney U test, and bootstrap 95% CIs are computed for the relative
+change of p50 and p95. A scenario is "regress" when the test is significant
+and the CI of either percentile change lies entirely above +threshold,
+"improve" when significant and entirely below -threshold, else "pass".
+A baseline scenario with no transfers in the new run is "missing".
+Exits with status 1 if any scenario regresses or is missing.
+
+The baseline keeps each transfer's run_id; transfers from blessed runs are
+dropped from the new run, so comparing against the same (appended-to) log
+directory only looks at what was run after blessing.
+"""
+import argparse
+import math
+import os
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from tools.aggregate_results import DEFAULT_IMPAIRMENT, load_csvs, transfer_events
+
+SCENARIO_KEYS = ["protocol", "impairment", "qos_or_mode", "file_size_bytes"]
+
+
+def load_durations(log_dir: str) -> pd.DataFrame:
+    """One row per transfer: scenario keys + duration_ms + run_id, across all protocols."""
+    frames: List[pd.DataFrame] = []
+    for df, size_col in transfer_events(load_csvs(log_dir)).values():
+        frames.append(pd.DataFrame({
+            "protocol": df["protocol"],
+            "impairment": df["impairment"],
+            "qos_or_mode": df["qos_or_mode"],
+            "file_size_bytes": df[size_col].astype(int),
+            "duration_ms": df["duration_ms"].astype(float),
+            "run_id": df["run_id"],
+        }))
+    if not frames:
+        return pd.DataFrame(columns=SCENARIO_KEYS + ["duration_ms", "run_id"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def mann_whitney_u(new: np.ndarray, base: np.ndarray) -> Tuple[float, float]:
+    """Two-sided Mann-Whitney U (normal approximation, tie and continuity corrected).
+    Returns (U of `new`, p-value).
+    """
+    n1, n2 = len(new), len(base)
+    combined = np.concatenate([new, base])
+    ranks = pd.Series(combined).rank(method="average").to_numpy()
+    u1 = ranks[:n1].sum() - n1 * (n1 + 1) / 2.0
+    n = n1 + n2
+    _, ties = np.unique(combined, return_counts=True)
+    tie_term = float((ties ** 3 - ties).sum()) / (n * (n - 1))
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - tie_term))
+    if sigma == 0:
+        return u1, 1.0
+    delta = u1 - n1 * n2 / 2.0
+    z = (abs(delta) - 0.5) / sigma
+    return u1, math.erfc(max(z, 0.0) / math.sqrt(2))
+
+
+def bootstrap_rel_change_ci(new: np.ndarray, base: np.ndarray, q: float, n_boot: int,
+                            rng: np.random.Generator, chunk: int = 256) -> Tuple[float, float]:
+    """95% bootstrap CI of quantile(new, q) / quantile(base, q) - 1."""
+    stats: List[np.ndarray] = []
+    for start in range(0, n_boot, chunk):
+        b = min(chunk, n_boot - start)
+        qn = np.quantile(new[rng.integers(0, len(new), size=(b, len(new)))], q, axis=1)
+        qb = np.quantile(base[rng.integers(0, len(base), size=(b, len(base)))], q, axis=1)
+        stats.append(qn / np.maximum(qb, 1e-12) - 1.0)
+    all_stats = np.concatenate(stats)
+    return float(np.quantile(all_stats, 0.025)), float(np.quantile(all_stats, 0.975))
+
+
+def compare(baseline: pd.DataFrame, current: pd.DataFrame, threshold: float, alpha: float,
+            n_boot: int, min_samples: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    base_groups: Dict[tuple, np.ndarray] = {
+        k: g["duration_ms"].to_numpy() for k, g in baseline.groupby(SCENARIO_KEYS)
+    }
+    rows = []
+    for key, g in current.groupby(SCENARIO_KEYS):
+        new = g["duration_ms"].to_numpy()
+        base = base_groups.get(key)
+        row = dict(zip(SCENARIO_KEYS, key))
+        row.update(n_base=0 if base is None else len(base), n_new=len(new))
+        if base is None or len(base) < min_samples or len(new) < min_samples:
+            row["verdict"] = "no-baseline" if base is None else "too-few"
+            rows.append(row)
+            continue
+        u1, p = mann_whitney_u(new, base)
+        p50_lo, p50_hi = bootstrap_rel_change_ci(new, base, 0.5, n_boot, rng)
+        p95_lo, p95_hi = bootstrap_rel_change_ci(new, base, 0.95, n_boot, rng)
+        significant = p < alpha
+        if significant and (p50_lo > threshold or p95_lo > threshold):
+            verdict = "regress"
+        elif significant and (p50_hi < -threshold or p95_hi < -threshold):
+            verdict = "improve"
+        else:
+            verdict = "pass"
+        row.update(
+            base_p50_ms=float(np.median(base)),
+            new_p50_ms=float(np.median(new)),
+            p50_change=float(np.median(new) / max(np.median(base), 1e-12) - 1.0),
+            p50_ci_lo=p50_lo,
+            p50_ci_hi=p50_hi,
+            base_p95_ms=float(np.quantile(base, 0.95)),
+            new_p95_ms=float(np.quantile(new, 0.95)),
+            p95_change=float(np.quantile(new, 0.95) / max(np.quantile(base, 0.95), 1e-12) - 1.0),
+            p95_ci_lo=p95_lo,
+            p95_ci_hi=p95_hi,
+            # Cliff's delta: P(new > base) - P(new < base); > 0 means slower
+            cliffs_delta=2.0 * u1 / (len(new) * len(base)) - 1.0,
+            p_value=p,
+            verdict=verdict,
+        )
+        rows.append(row)
+    seen = set(current.groupby(SCENARIO_KEYS).groups)
+    for key, base in base_groups.items():
+        if key not in seen:
+            rows.append({**dict(zip(SCENARIO_KEYS, key)), "n_base": len(base), "n_new": 0, "verdict": "missing"})
+    return pd.DataFrame(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    bless = sub.add_parser("bless", help="Store this run's distributions as the baseline")
+    bless.add_argument("--logs", default="logs")
+    bless.add_argument("--baseline", required=True)
+
+    cmp_ = sub.add_parser("compare", help="Compare this run against the baseline")
+    cmp_.add_argument("--logs", default="logs")
+    cmp_.add_argument("--baseline", required=True)
+    cmp_.add_argument("--threshold", type=float, default=0.05, help="Relative p50/p95 change that counts (0.05 = 5%%)")
+    cmp_.add_argument("--alpha", type=float, default=0.01, help="Significance level of the Mann-Whitney test")
+    cmp_.add_argument("--bootstrap", type=int, default=2000)
+    cmp_.add_argument("--min-samples", type=int, default=5)
+    cmp_.add_argument("--seed", type=int, default=0)
+    cmp_.add_argument("--out", default=None, help="Also write the table as CSV")
+    args = parser.parse_args()
+
+    current = load_durations(args.logs)
+    if current.empty:
+        raise SystemExit(f"No transfer logs found under {args.logs}")
+
+    if args.cmd == "bless":
+        if os.path.dirname(args.baseline):
+            os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        current.to_csv(args.baseline, index=False)
+        scenarios = current.groupby(SCENARIO_KEYS).size()
+        print(f"Blessed {len(current)} transfers in {len(scenarios)} scenarios -> {args.baseline}")
+        return
+
+    baseline = pd.read_csv(args.baseline)
+    if "impairment" not in baseline.columns:
+        baseline["impairment"] = DEFAULT_IMPAIRMENT
+    if "run_id" in baseline.columns:
+        blessed = current["run_id"].isin(set(baseline["run_id"].dropna()))
+        if blessed.any():
+            print(f"Ignoring {int(blessed.sum())} transfers from blessed runs")
+            current = current[~blessed]
+    table = compare(baseline, current, args.threshold, args.alpha, args.bootstrap, args.min_samples, args.seed)
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.4g}".format):
+        print(table.to_string(index=False))
+    if args.out:
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        table.to_csv(args.out, index=False)
+    if table["verdict"].isin(["regress", "missing"]).any():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
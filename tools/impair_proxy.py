@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""User-space TCP/UDP relay that injects delay, jitter, loss, reordering and a
+token-bucket bandwidth cap between clients and servers/broker (no root or tc).
+
+UDP datagrams get every impairment independently. Reordered datagrams skip the
+delay (netem semantics), so reordering needs a non-zero delay to show up.
+TCP is a byte stream, so data is never dropped or reordered: each chunk is
+delayed (in order) and rate-limited, and a chunk in which any of its MSS-sized
+segments is "lost" is held back for a retransmission timeout instead,
+approximating what the sender's TCP would do.
+"""
+import argparse
+import asyncio
+import random
+from typing import Dict, List, Tuple
+
+from common.config import Settings
+from common.impairment import ImpairmentProfile, load_profile
+from common.logging_utils import write_run_meta
+
+# Minimum RTO (RFC 6298 allows 200ms in practice on Linux) used for TCP "loss".
+TCP_MIN_RTO_S = 0.2
+READ_CHUNK = 64 * 1024
+# Ethernet MSS with TCP timestamps; TCP loss is drawn per segment of this size
+TCP_MSS = 1448
+
+
+class TokenBucket:
+    def __init__(self, rate_kbps: float, burst_bytes: int) -> None:
+        self.rate_bps = rate_kbps * 1000 / 8  # bytes per second
+        self.burst = burst_bytes
+        self.tokens = float(burst_bytes)
+        self.last = 0.0
+
+    def reserve(self, nbytes: int, now: float) -> float:
+        """Take nbytes and return how long (s) the caller must wait for them."""
+        if self.rate_bps <= 0:
+            return 0.0
+        if self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate_bps)
+        self.last = now
+        self.tokens -= nbytes
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate_bps
+
+
+class Direction:
+    """Impairment state for one direction of one flow."""
+
+    def __init__(self, profile: ImpairmentProfile, rng: random.Random) -> None:
+        self.profile = profile
+        self.rng = rng
+        self.bucket = TokenBucket(profile.rate_kbps, profile.burst_bytes)
+        self.last_departure = 0.0
+
+    def delay_s(self) -> float:
+        p = self.profile
+        jitter = self.rng.uniform(-p.jitter_ms, p.jitter_ms) if p.jitter_ms else 0.0
+        return max(0.0, p.delay_ms + jitter) / 1000.0
+
+    def lost(self, packets: int = 1) -> bool:
+        """True if any of `packets` independently drawn packets is lost."""
+        p = self.profile.loss
+        return p > 0 and self.rng.random() < 1.0 - (1.0 - p) ** packets
+
+    def reordered(self) -> bool:
+        return self.profile.reorder > 0 and self.rng.random() < self.profile.reorder
+
+
+class UdpRelay:
+    """One upstream socket per client address so replies map back to it.
+
+    A flow is opened once even when several first datagrams of a new client
+    arrive while its upstream socket is being created, and is closed after
+    idle_s without traffic in either direction.
+    """
+
+    class _Downstream(asyncio.DatagramProtocol):
+        def __init__(self, relay: "UdpRelay") -> None:
+            self.relay = relay
+
+        def connection_made(self, transport) -> None:
+            self.relay.listen_transport = transport
+
+        def datagram_received(self, data: bytes, addr) -> None:
+            asyncio.ensure_future(self.relay.from_client(data, addr))
+
+    class _Upstream(asyncio.DatagramProtocol):
+        def __init__(self, relay: "UdpRelay", client_addr) -> None:
+            self.relay = relay
+            self.client_addr = client_addr
+
+        def datagram_received(self, data: bytes, addr) -> None:
+            self.relay.from_server(data, self.client_addr)
+
+    class _Flow:
+        def __init__(self, transport: asyncio.DatagramTransport, up: Direction, down: Direction, now: float) -> None:
+            self.transport = transport
+            self.up = up
+            self.down = down
+            self.last_active = now
+
+    def __init__(self, target: Tuple[str, int], profile: ImpairmentProfile, rng: random.Random, idle_s: float = 60.0) -> None:
+        self.target = target
+        self.profile = profile
+        self.rng = rng
+        self.idle_s = idle_s
+        self.listen_transport = None
+        self.flows: Dict[tuple, "UdpRelay._Flow"] = {}
+        self._opening: Dict[tuple, asyncio.Task] = {}
+
+    async def _open_flow(self, addr) -> "UdpRelay._Flow":
+        loop = asyncio.get_running_loop()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: self._Upstream(self, addr), remote_addr=self.target
+            )
+            flow = self._Flow(transport, Direction(self.profile, self.rng), Direction(self.profile, self.rng), loop.time())
+            self.flows[addr] = flow
+            return flow
+        finally:
+            del self._opening[addr]
+
+    async def from_client(self, data: bytes, addr) -> None:
+        flow = self.flows.get(addr)
+        if flow is None:
+            # Registered before the first await, so concurrent packets share it
+            opening = self._opening.get(addr)
+            if opening is None:
+                opening = self._opening[addr] = asyncio.ensure_future(self._open_flow(addr))
+            try:
+                flow = await opening
+            except OSError:
+                return
+        flow.last_active = asyncio.get_running_loop().time()
+        upstream = flow.transport
+        self._schedule(flow.up, data, lambda d: upstream.sendto(d))
+
+    def from_server(self, data: bytes, client_addr) -> None:
+        flow = self.flows.get(client_addr)
+        if flow is None:
+            return
+        flow.last_active = asyncio.get_running_loop().time()
+        self._schedule(flow.down, data, lambda d: self.listen_transport.sendto(d, client_addr))
+
+    async def expire_idle(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.idle_s / 2)
+            now = loop.time()
+            for addr, flow in list(self.flows.items()):
+                if now - flow.last_active > self.idle_s:
+                    flow.transport.close()
+                    del self.flows[addr]
+
+    def _schedule(self, direction: Direction, data: bytes, send) -> None:
+        if direction.lost():
+            return
+        loop = asyncio.get_running_loop()
+        wait = direction.bucket.reserve(len(data), loop.time())
+        if not direction.reordered():
+            wait += direction.delay_s()
+        if wait > 0:
+            loop.call_later(wait, send, data)
+        else:
+            send(data)
+
+
+async def _pump_tcp(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, direction: Direction) -> None:
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def deliver() -> None:
+        while True:
+            departure, chunk = await queue.get()
+            if chunk is None:
+                break
+            wait = departure - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            writer.write(chunk)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    sender = asyncio.ensure_future(deliver())
+    try:
+        while True:
+            chunk = await reader.read(READ_CHUNK)
+            if not chunk:
+                break
+            now = loop.time()
+            hold = direction.bucket.reserve(len(chunk), now) + direction.delay_s()
+            if direction.lost(-(-len(chunk) // TCP_MSS)):
+                hold += max(TCP_MIN_RTO_S, 2 * direction.profile.delay_ms / 1000.0)
+            # Streams stay in order: never depart before the previous chunk.
+            departure = max(now + hold, direction.last_departure)
+            direction.last_departure = departure
+            queue.put_nowait((departure, chunk))
+    except ConnectionError:
+        pass
+    finally:
+        queue.put_nowait((0.0, None))
+        try:
+            await sender
+        except ConnectionError:
+            pass
+
+
+async def serve_tcp(listen: Tuple[str, int], target: Tuple[str, int], profile: ImpairmentProfile, rng: random.Random):
+    async def handle(client_reader, client_writer) -> None:
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*target)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(
+            _pump_tcp(client_reader, server_writer, Direction(profile, rng)),
+            _pump_tcp(server_reader, client_writer, Direction(profile, rng)),
+        )
+        for w in (client_writer, server_writer):
+            w.close()
+
+    return await asyncio.start_server(handle, *listen)
+
+
+def parse_mapping(spec: str) -> Tuple[Tuple[str, int], Tuple[str, int]]:
+    """[LISTEN_HOST:]LISTEN_PORT:TARGET_HOST:TARGET_PORT"""
+    parts = spec.split(":")
+    if len(parts) == 3:
+        parts = ["127.0.0.1"] + parts
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError(f"bad mapping {spec!r}")
+    return (parts[0], int(parts[1])), (parts[2], int(parts[3]))
+
+
+async def main_async(tcp: List, udp: List, profile: ImpairmentProfile, seed, udp_idle_s: float = 60.0) -> None:
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    for listen, target in tcp:
+        await serve_tcp(listen, target, profile, rng)
+    reapers = []
+    for listen, target in udp:
+        relay = UdpRelay(target, profile, rng, udp_idle_s)
+        await loop.create_datagram_endpoint(lambda relay=relay: UdpRelay._Downstream(relay), local_addr=listen)
+        reapers.append(asyncio.ensure_future(relay.expire_idle()))
+    await loop.create_future()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tcp", action="append", type=parse_mapping, default=[],
+                        help="[LISTEN_HOST:]LISTEN_PORT:TARGET_HOST:TARGET_PORT (repeatable)")
+    parser.add_argument("--udp", action="append", type=parse_mapping, default=[],
+                        help="[LISTEN_HOST:]LISTEN_PORT:TARGET_HOST:TARGET_PORT (repeatable)")
+    parser.add_argument("--profile", default=None, help="Profile name (default: IMPAIRMENT_PROFILE or none)")
+    parser.add_argument("--profiles-file", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--udp-idle-timeout", type=float, default=60.0,
+                        help="Close a UDP client's upstream socket after this many idle seconds")
+    args = parser.parse_args()
+
+    if not args.tcp and not args.udp:
+        parser.error("give at least one --tcp or --udp mapping")
+
+    settings = Settings.load()
+    profile = load_profile(args.profile, args.profiles_file)
+    write_run_meta(settings.log_dir, "proxy", "proxy", {
+        "impairment": profile.to_map(),
+        "tcp": [f"{l[0]}:{l[1]}->{t[0]}:{t[1]}" for l, t in args.tcp],
+        "udp": [f"{l[0]}:{l[1]}->{t[0]}:{t[1]}" for l, t in args.udp],
+    })
+
+    try:
+        asyncio.run(main_async(args.tcp, args.udp, profile, args.seed, args.udp_idle_timeout))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()